@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from fakes import FakeUserAPI, FakeMariaDBApi, FakePHPPoolApi, fake_passgen
+from mm import MortalManager, AsyncMortalManager
+from registry import AccountRegistry
+from store import AccountStore
+from tasker import Tasker
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+def report(name, count, elapsed, latencies):
+    print("%-30s %6d %10.1f %10.2f %10.2f" % (
+        name, count, count / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+def measure(func, items):
+    latencies = []
+    start = time.monotonic()
+    for item in items:
+        t = time.monotonic()
+        func(item)
+        latencies.append(time.monotonic() - t)
+    return time.monotonic() - start, latencies
+
+def makeManager(args, tmp, n):
+    store = AccountStore(os.path.join(tmp, "bench-%d-%d.sqlite3" % (n, time.time_ns())))
+    return MortalManager(
+        FakeUserAPI(args.latency, args.item_latency),
+        FakePHPPoolApi(args.latency, args.item_latency, args.reload_latency),
+        fake_passgen(),
+        registry=AccountRegistry(store),
+        dbapi=FakeMariaDBApi(args.latency, args.item_latency),
+        name_digits=len(str(n)) + 1,
+    )
+
+def benchSequential(args, tmp, n):
+    manager = makeManager(args, tmp, n)
+
+    elapsed, latencies = measure(lambda _: manager.create_mortal(), range(n))
+    report("create_mortal", n, elapsed, latencies)
+    names = list(manager.mortals)
+
+    elapsed, latencies = measure(manager.password_reset, names)
+    report("password_reset", n, elapsed, latencies)
+
+    elapsed, latencies = measure(manager.remove_mortal, names)
+    report("remove_mortal", n, elapsed, latencies)
+
+def benchBatch(args, tmp, n):
+    manager = makeManager(args, tmp, n)
+
+    start = time.monotonic()
+    created = manager.create_mortals(n)
+    elapsed = time.monotonic() - start
+    report("create_mortals (batch)", len(created), elapsed, [elapsed])
+
+    start = time.monotonic()
+    manager.password_reset_many([name for name, _ in created])
+    elapsed = time.monotonic() - start
+    report("password_reset_many (batch)", len(created), elapsed, [elapsed])
+
+async def benchQueued(args, tmp, n):
+    manager = AsyncMortalManager(makeManager(args, tmp, n), max_workers=args.workers)
+    queue = Tasker(workers=args.workers, name="bench")
+    await queue.start()
+    await asyncio.sleep(0)
+
+    async def run(name, jobs):
+        latencies = []
+        loop = asyncio.get_running_loop()
+        finished = [loop.create_future() for _ in jobs]
+
+        async def job(coro, added, future):
+            try:
+                future.set_result(await coro)
+            except Exception as e:
+                future.set_exception(e)
+            latencies.append(time.monotonic() - added)
+
+        start = time.monotonic()
+        for (coro, keys), future in zip(jobs, finished):
+            await queue.addJob(job(coro, time.monotonic(), future), keys=keys)
+        results = await asyncio.gather(*finished, return_exceptions=True)
+        report(name, n, time.monotonic() - start, latencies)
+        return results
+
+    results = await run("queued create_mortal", [(manager.create_mortal(), ()) for _ in range(n)])
+    names = [name for name in results if isinstance(name, str)]
+    await run("queued password_reset", [(manager.password_reset(name), (name,)) for name in names])
+    await run("queued remove_mortal", [(manager.remove_mortal(name), (name,)) for name in names])
+    manager.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MortalManager and Tasker against fake backends")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds per backend call")
+    parser.add_argument("--item-latency", type=float, default=0.0002, help="seconds per account in batch calls")
+    parser.add_argument("--reload-latency", type=float, default=0.05, help="seconds per PHP-FPM reload")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            print("\n%d accounts" % n)
+            print("%-30s %6s %10s %10s %10s" % ("operation", "ops", "ops/sec", "p50 ms", "p99 ms"))
+            benchSequential(args, tmp, n)
+            benchBatch(args, tmp, n)
+            asyncio.run(benchQueued(args, tmp, n))
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,97 @@
 import os
 import re
-import json
+import atexit
+import time
 import base64
+import itertools
 import asyncio
 import discord
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from systemd.journal import JournaldLogHandler
 from discord.ext import commands
 from dotenv import load_dotenv
 
-from mm import MortalManager
-from tasker import Tasker
-
-# Config should be readonly!
+from mm import MortalManager, AsyncMortalManager
+from store import AccountStore
+from registry import AccountRegistry
+from journal import Journal
+from tasker import Tasker, JobFilter, QueueFullError, INTERACTIVE, READ, BULK
+from usercache import UserCache
+from usage import UsageCache
+from outbox import Outbox
+from config import Config
+from profiler import Profiler
+import metrics
+
+# Config is readonly, it can only be replaced as a whole by reloadConfig()
 def getConfig():
-    with open ("conf.json","r") as f:
-        return json.loads(f.read())
+    return Config.load(os.getenv('ADMINBOT_CONF', "conf.json"))
 
 #def saveConfig():
 #    with open ("conf.json","w") as f:
 #        f.write(json.dumps(config))
 
-# TODO: Add real database support
-EMPTY_DB = {"discords": {}, "mortals": []}
-
-def getDb():
-    if not os.path.isfile("db.json"):
-        logging.info("New database!")
-        return EMPTY_DB
-    with open ("db.json","r") as f:
-        return json.loads(f.read())
-
-def saveDb():
-    with open ("db.json","w") as f:
-        f.write(json.dumps(db))
+def getRegistry():
+    # migrate old whole-file database on first start
+    if store.import_json("db.json"):
+        logging.info("Migrated db.json to the new database!")
+    return AccountRegistry(store)
 
 def isGod(uid):
-    return (str(uid) in config["userapi"]["admins"])
+    return int(uid) in config.admins
+
+async def reloadConfig():
+    """ Load changed config file and rebuild parts whose sections changed, return their names """
+    global config
+    async with configLock:
+        new = Config.load(config.path)
+        changed = await serverManager.reconfigure(config, new)
+        if config["userapi"]["admins"] != new["userapi"]["admins"]:
+            changed.append("admins")
+        userapi = new["userapi"]
+        if (usageCache.base_dir, usageCache.quota_fs) != (userapi["base_dir"], userapi.get("quota_fs")):
+            usageCache.base_dir, usageCache.quota_fs = userapi["base_dir"], userapi.get("quota_fs")
+            usageCache.usage = {}
+            usageCache.updated = None   # nothing to show until all homes are measured again
+        if config.get("metrics") != new.get("metrics"):
+            logging.warning("Metrics endpoint change needs restart of the bot")
+        config = new
+    logging.info("Reloaded config, changed: %s", ', '.join(changed) or 'nothing')
+    return changed
+
+async def watchConfig(interval=5):
+    # reload config when its file is modified, bad config is reported once and ignored
+    failed = None
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.stat(config.path).st_mtime
+        except OSError:
+            continue
+        if mtime == config.mtime or mtime == failed:
+            continue
+        try:
+            await reloadConfig()
+        except Exception as e:
+            failed = mtime
+            logging.error("Config reload failed, keeping the old one: %s", e)
 
-def recovery(discord_id):
-    user=db["discords"][str(discord_id)]
-    return serverManager.password_reset(user)
+async def recovery(discord_id):
+    user=registry.login_of(discord_id)
+    if user is None:
+        raise KeyError(discord_id)
+    return await serverManager.password_reset(user)
 
-async def getMentionedUsers(ctx, db):
+async def getMentionedUsers(ctx):
     # return all users mentioned individually and from ranks
     # if only word "all" in command - return all users in database
     users = []
 
     if ''.join(ctx.message.content.lower().split()[1:]) == "all":
-        for userid in db["discords"]:
-            users.append(await bot.fetch_user(int(userid)))
-        return users
+        users = await userCache.get_many(list(registry.discords()))
+        return [user for user in users if user]
 
     users.extend(ctx.message.mentions)
     for rank in ctx.message.role_mentions:
@@ -58,12 +99,41 @@ async def getMentionedUsers(ctx, db):
 
     return users
 
+def mentionedMembers(ctx):
+    # return users mentioned individually and from ranks, each once
+    users = {user.id: user for user in ctx.message.mentions}
+    for rank in ctx.message.role_mentions:
+        users.update((user.id, user) for user in rank.members)
+    return list(users.values())
+
+def operationKeys(ops):
+    # return discord ids and logins touched by journal operations
+    keys = set()
+    for op in ops:
+        keys.update(op.args[arg] for arg in ("owner", "login") if op.args.get(arg))
+    return keys
+
+async def enqueue(ctx, queue, coro, keys=(), priority=BULK, shared=False, ops=()):
+    # add job to the queue, tell user to come back later if it's full
+    # the same command repeated by the same user in the same channel is merged into
+    # the waiting one (or into the running one if it only reads, so it can share its answer)
+    # journal operations of job which won't run are finished right away
+    dedup = (ctx.author.id, ctx.channel.id, ' '.join(ctx.message.content.split()))
+    try:
+        if not await queue.addJob(coro, keys=keys, priority=priority, dedup=dedup, shared=shared):
+            journal.done(ops)
+            outbox.unreact(ctx.message, '⌛', bot.user)
+            outbox.react(ctx.message, '🔁')
+    except QueueFullError:
+        journal.done(ops)
+        logging.warning("Queue %s is full, rejected %s", queue.name, ctx.message.content, extra={"discord_id": ctx.author.id})
+        outbox.unreact(ctx.message, '⌛', bot.user)
+        outbox.react(ctx.message, '❌')
+        outbox.send(ctx, "Bot jest teraz zajęty, spróbuj ponownie za chwilę.")
+
 # --------------- Initial setup ---------------
 
 # Logs
-# get an instance of the logger object this module will use
-logger = logging.getLogger("adminbot")
-
 # instantiate the JournaldLogHandler to hook into systemd
 journald_handler = JournaldLogHandler()
 
@@ -72,26 +142,43 @@ journald_handler.setFormatter(logging.Formatter(
     '[%(levelname)s] %(asctime)s - %(message)s'
 ))
 
-# add the journald handler to the current logger
-logger.addHandler(journald_handler)
-
-# optionally set the logging level
-logger.setLevel(logging.INFO)
+# records are only put into a queue by the logging thread (event loop too),
+# the listener thread sends them to journald together with their extra fields
+# (job_id, login, discord_id, stage, duration), so e.g. one job can be followed
+# with: journalctl -u adminbot JOB_ID=main-42
+logQueue = SimpleQueue()
+queue_handler = QueueHandler(logQueue)
+queue_handler.addFilter(JobFilter())
+logging.getLogger().addHandler(queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+logListener = QueueListener(logQueue, journald_handler, respect_handler_level=True)
+logListener.start()
+# listener thread is a daemon, records still in the queue would be lost at exit
+atexit.register(logListener.stop)
 logging.info("Starting new session...")
 
 # Queue
-mainQueue = Tasker()    # for tasks that change users data (register, kill, password, etc..)
-secondQueue = Tasker()  # for reading-only tasks (whois, etc..)
+# users' own requests overtake admins' jobs, too many waiting jobs are rejected
+mainQueue = Tasker(workers=4, name="main", maxsize=500)     # for tasks that change users data (register, kill, password, etc..)
+secondQueue = Tasker(workers=4, name="second", maxsize=500) # for reading-only tasks (whois, etc..)
 
 # Discord bot
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 bot = commands.Bot(command_prefix='$')
+userCache = UserCache(bot)
+outbox = Outbox()   # all messages and reactions go through it, never awaited by jobs
 
 # Other
 config = getConfig()
-db = getDb()
-serverManager = MortalManager.from_save(config, db)
+configLock = asyncio.Lock()
+store = AccountStore(os.getenv('ADMINBOT_DB', "db.sqlite3"))
+registry = getRegistry()
+journal = Journal(store)    # operations changing accounts, to be finished after restart
+interrupted = []            # operations left by the last run, resumed when bot is ready
+serverManager = AsyncMortalManager(MortalManager.from_save(config, registry, journal))
+usageCache = UsageCache(config["userapi"]["base_dir"], config["userapi"].get("quota_fs"))
+profiler = Profiler((mainQueue, secondQueue))
 
 # --------------- Bot commands ---------------
 
@@ -100,53 +187,137 @@ serverManager = MortalManager.from_save(config, db)
 async def register(ctx):
     """ Create account """
     if not isGod(ctx.author.id):
-        await ctx.message.add_reaction('🛑')
-        await ctx.send("Nie dla psa! Dla Adminów to!")
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
         return
     
-    await ctx.message.add_reaction('⌛')
-    await mainQueue.addJob(registerCoro(ctx))
-
-async def registerCoro(ctx):
-    for user in await getMentionedUsers(ctx, db):
+    outbox.react(ctx.message, '⌛')
+    ops = journal.begin("create", [{"owner": str(user.id)} for user in mentionedMembers(ctx)])
+    await enqueue(ctx, mainQueue, registerCoro(ctx, ops), keys=operationKeys(ops), ops=ops)
+
+def registrationEmbed(login, newdata):
+    embed=discord.Embed(title="Tryton", url="https://tryton.vlo.gda.pl", description="Sleep less, code more!", color=0x11ff00)
+    embed.add_field(name="Utworzono dla Ciebie konto na serwerze Tryton", value="https://tryton.vlo.gda.pl", inline=False)
+    embed.add_field(name="Login", value=f"```{login}```", inline=False)
+    embed.add_field(name="Hasło", value=f"```{newdata[0]}```", inline=False)
+    embed.add_field(name="Nazwa bazy danych", value=f"```db{login}```", inline=False)
+    embed.add_field(name="Hasło bazy danych", value=f"```{newdata[1]}```", inline=False)
+    embed.set_footer(text="Jeśli kiedyś zapomnisz hasła, użyj komendy $password")
+    return embed
+
+async def registerCoro(ctx, ops):
+    report = outbox.report(ctx)
+    await createAccounts(report, ops)
+    report.finish(bot.user)
+
+async def createAccounts(report, ops):
+    """ Create accounts of journal operations, then send passwords to their owners """
+    todo, created = [], []
+    for op in ops:
         # check if user already exists
-        if str(user.id) in db["discords"]:
-            await ctx.message.add_reaction('⚠')
-            await ctx.send(f"Ten użytkownik ma już konto: {db['discords'][str(user.id)]}")
-            continue
+        login = registry.login_of(op.args["owner"])
+        if login and login == op.args.get("login"):
+            # created by this operation before restart, only its DM wasn't sent
+            created.append(op)
+        elif login:
+            report.react('⚠')
+            report.add(f"Ten użytkownik ma już konto: {login}")
+            journal.done([op])
+        else:
+            todo.append(op)
 
-        out = None
+    if created:
+        await resendAccounts(report, created)
+
+    users, found = [], []
+    for user, op in zip(await userCache.get_many([op.args["owner"] for op in todo]), todo):
+        if user is None:
+            report.react('⚠')
+            report.add(f"Nie można utworzyć konta dla: {op.args['owner']}")
+            journal.done([op])
+        else:
+            users.append(user)
+            found.append(op)
+
+    if len(users) > 1:
+        await registerMany(report, users, found)
+    elif users:
+        await registerOne(report, users[0], found[0])
+
+async def resendAccounts(report, ops):
+    """ Send data of accounts created before restart with new passwords, the old ones were never sent """
+    for user, op in zip(await userCache.get_many([op.args["owner"] for op in ops]), ops):
+        login = op.args["login"]
         try:
-            out = serverManager.create_mortal()
+            if user is None:
+                report.react('⚠')
+                report.add(f"Utworzono użytkownika {login}, ale nie można wysłać danych do: {op.args['owner']}")
+                continue
+            newdata = await recovery(user.id)
+            logging.info("Created user: %s", login, extra={"login": login, "discord_id": user.id})
+            report.react('📬')
+            report.add(f"Utworzono użytkownika: {login}")
+            report.dm(user, f"Nie udało się wysłać danych konta {login} do {user.display_name}", embed=registrationEmbed(login, newdata))
         except Exception as e:
-            logging.exception(f"Exception while creating user: {e}")
-            out = None
-            pass    # TODO: Add exception handling
+            logging.exception("Exception while resending account: %s", e, extra={"login": login, "discord_id": user.id})
+            report.react('⚠')
+            report.add(f"Nie udało się wysłać danych konta {login} do {user.display_name}")
+        finally:
+            journal.done([op])
+
+async def registerOne(report, user, op):
+    """ Create account for the user, then send password """
+    try:
+        out = await serverManager.create_mortal(owner=str(user.id), op=op)
+    except Exception as e:
+        logging.exception("Exception while creating user: %s", e, extra={"discord_id": user.id})
+        out = None
+        pass    # TODO: Add exception handling
 
+    try:
         if out:
-            # Update db
-            db["mortals"] = list(serverManager.mortals)
-            db["discords"][str(user.id)] = out
-            saveDb()
-
             # Message success
-            logging.info(f"Created user: {out}")
-            await ctx.message.add_reaction('📬')
-            await ctx.send(f"Utworzono użytkownika: {out}")   
-            newdata = recovery(user.id)
-            embed=discord.Embed(title="Tryton", url="https://tryton.vlo.gda.pl", description="Sleep less, code more!", color=0x11ff00)
-            embed.add_field(name="Utworzono dla Ciebie konto na serwerze Tryton", value="https://tryton.vlo.gda.pl", inline=False)
-            embed.add_field(name="Login", value=f"```{out}```", inline=False)
-            embed.add_field(name="Hasło", value=f"```{newdata[0]}```", inline=False)
-            embed.add_field(name="Nazwa bazy danych", value=f"```db{out}```", inline=False)
-            embed.add_field(name="Hasło bazy danych", value=f"```{newdata[1]}```", inline=False)
-            embed.set_footer(text="Jeśli kiedyś zapomnisz hasła, użyj komendy $password")
-            await user.send(embed=embed)
+            logging.info("Created user: %s", out, extra={"login": out, "discord_id": user.id})
+            report.react('📬')
+            report.add(f"Utworzono użytkownika: {out}")
+            newdata = await recovery(user.id)
+            report.dm(user, f"Nie udało się wysłać danych konta {out} do {user.display_name}", embed=registrationEmbed(out, newdata))
         else:
-            await ctx.message.add_reaction('⚠')
-            await ctx.send(f"Nie można utworzyć konta dla: {user}")
-    
-    await ctx.message.remove_reaction('⌛', bot.user)
+            report.react('⚠')
+            report.add(f"Nie można utworzyć konta dla: {user}")
+    finally:
+        journal.done([op])
+
+async def registerMany(report, users, ops):
+    """ Create accounts for all provided users in one batch, then send passwords """
+    try:
+        created = await serverManager.create_mortals(len(users), owners=[str(user.id) for user in users], ops=ops)
+    except Exception as e:
+        logging.exception("Exception while creating users: %s", e)
+        created = []
+    passwords = dict(created)
+
+    failed = []
+    for user in users:
+        login = registry.login_of(user.id)
+        if login in passwords:
+            logging.info("Created user: %s", login, extra={"login": login, "discord_id": user.id})
+        else:
+            failed.append(str(user))
+
+    summary = f"Utworzono konta: {len(created)}/{len(users)}"
+    if failed:
+        report.react('⚠')
+        summary += "\nNie można utworzyć konta dla: " + ", ".join(failed)
+    else:
+        report.react('📬')
+    report.add(summary)
+
+    for user in users:
+        login = registry.login_of(user.id)
+        if login in passwords:
+            report.dm(user, f"Nie udało się wysłać danych konta {login} do {user.display_name}", embed=registrationEmbed(login, passwords[login]))
+    journal.done(ops)
 
 
 @commands.cooldown(1,10)
@@ -154,117 +325,149 @@ async def registerCoro(ctx):
 async def kill(ctx):
     """ Remove account """
     if not isGod(ctx.author.id):
-        await ctx.message.add_reaction('🛑')
-        await ctx.send("Nie dla psa! Dla Adminów to!")
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
         return
 
-    await ctx.message.add_reaction('⌛')
-    await mainQueue.addJob(killCoro(ctx))
-
-async def killCoro(ctx):
-    # Remove by discord username
-    for user in ctx.message.mentions:
+    outbox.react(ctx.message, '⌛')
+    ops = journal.begin("remove", removalTargets(ctx))
+    await enqueue(ctx, mainQueue, killCoro(ctx, ops), keys=operationKeys(ops), ops=ops)
+
+def removalTargets(ctx):
+    # by discord username
+    targets = [{"login": registry.login_of(user.id), "user": user.display_name} for user in ctx.message.mentions]
+
+    # by server username (s1, s2, etc..)
+    for word in ctx.message.content.split()[1:]:
+        if "@" not in word and word.lower() != "all":
+            targets.append({"login": word})
+    return targets
+
+async def killCoro(ctx, ops):
+    report = outbox.report(ctx)
+    await removeAccounts(report, ops)
+    report.finish(bot.user)
+
+async def removeAccounts(report, ops):
+    """ Remove accounts of journal operations """
+    for op in ops:
+        login = op.args["login"]
+        user = op.args.get("user")
         try:
-            serverManager.remove_mortal(db["discords"][str(user.id)])
-
-            # Update config
-            db["mortals"] = list(serverManager.mortals)
-            db["discords"].pop(str(user.id),None)
-            saveDb()
+            if login is None:
+                raise KeyError(user)
+            await serverManager.remove_mortal(login)
 
             # Message success
-            logging.info(f"Deleted user: {user.display_name}")
-            await ctx.send(f"Usunięto konto: {user.display_name}")
-        except Exception as e:
-            logging.exception(f"Exception while killing user: {e}")
-            await ctx.message.add_reaction('⚠')
-            await ctx.send(f"Nie udało się usunąć konta użytkownika {user.display_name}")
-
-    # Remove by server username (s1, s2, etc..)
-    for user in ctx.message.content.split()[1:]:
-        try:
-            if "@" not in user and user.lower() != "all":
-                serverManager.remove_mortal(user)
-
-                # Update db
-                db["mortals"] = list(serverManager.mortals)
-                for i in db["discords"]:
-                    if db["discords"][i]==user:
-                        db["discords"].pop(i)
-                        break
-                saveDb()
-
-                # Message success
-                logging.info(f"Removed user: {user}")
-                await ctx.send(f"Usunięto konto: {user}")
+            logging.info("Removed user: %s", user or login, extra={"login": login})
+            report.add(f"Usunięto konto: {user or login}")
         except Exception as e:
-            logging.exception(f"Exception while killing user: {e}")
-            await ctx.message.add_reaction('⚠')
-            await ctx.send(f"Nie udało się usunąć konta {user}")
-    
-    await ctx.message.remove_reaction('⌛', bot.user)
+            logging.exception("Exception while killing user: %s", e, extra={"login": login})
+            report.react('⚠')
+            if user:
+                report.add(f"Nie udało się usunąć konta użytkownika {user}")
+            else:
+                report.add(f"Nie udało się usunąć konta {login}")
+        finally:
+            journal.done([op])
 
 
 @commands.cooldown(1,10)
 @bot.command(help="Zmienia hasło użytkownika")
 async def password(ctx):
     """ Reset caller's password """
-    await ctx.message.add_reaction('⌛')
-    await mainQueue.addJob(passwordCoro(ctx))
+    if len(ctx.message.content.split()) == 1:
+        # no mentioned users - reset author's password
+        targets = [{"owner": str(ctx.author.id), "login": registry.login_of(ctx.author.id)}]
+    elif isGod(ctx.author.id):
+        targets = resetTargets(ctx)
+    else:
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Normalni użytkownicy nie mogą resetować haseł innych osób.\nJeżeli próbujesz zmienić swoje hasło to użyj samej komendy bez oznaczania nikogo.")
+        return
 
-async def passwordReset(ctx, user, single=False):
-    """ Reset provided user's password and send according message """
-    try:
-        newdata = recovery(user.id)
+    outbox.react(ctx.message, '⌛')
+    ops = journal.begin("reset", targets)
+    # own password reset is more urgent than admin's resets of others
+    priority = INTERACTIVE if len(ctx.message.content.split()) == 1 else BULK
+    await enqueue(ctx, mainQueue, passwordCoro(ctx, ops), keys=operationKeys(ops), priority=priority, ops=ops)
+
+def resetTargets(ctx):
+    # if only word "all" in command - reset all users in database
+    words = ctx.message.content.split()[1:]
+    if ''.join(words).lower() == "all":
+        return [{"owner": owner, "login": login} for owner, login in registry.discords().items()]
+
+    # by discord username
+    targets = [{"owner": str(user.id), "login": registry.login_of(user.id)} for user in mentionedMembers(ctx)]
+
+    # by server username (s1, s2, etc..)
+    for word in words:
+        if "@" not in word and word.lower() != "all":
+            targets.append({"owner": registry.owner_of(word), "login": word})
+    return targets
+
+def passwordEmbed(newdata):
+    embed=discord.Embed(title="Tryton", url="https://tryton.vlo.gda.pl", description="Sleep less, code more!", color=0x44ff00)
+    embed.add_field(name="Przywracanie dostępu do konta", value="Twoje hasła zostały zresetowane", inline=False)
+    embed.add_field(name="Nowe hasło", value=f"```{newdata[0]}```", inline=False)
+    embed.add_field(name="Nowe hasło bazy danych", value=f"```{newdata[1]}```", inline=False)
+    return embed
+
+async def passwordCoro(ctx, ops):
+    report = outbox.report(ctx)
+    await resetPasswords(report, ops, single=len(ctx.message.content.split()) == 1)
+    report.finish(bot.user)
+
+async def resetPasswords(report, ops, single=False):
+    """ Reset passwords of accounts of journal operations at once, then send them to their owners """
+    targets = {}
+    owned = [op for op in ops if op.args["owner"]]
+    for op in ops:
+        if not op.args["owner"]:
+            report.react('⚠')
+            report.add(f"Użytkownik {op.args['login']} nie istnieje.")
+
+    users = await userCache.get_many([op.args["owner"] for op in owned])
+    for user, op in zip(users, owned):
+        # account could be changed while the job was waiting
+        login = registry.login_of(op.args["owner"])
+        name = user.display_name if user else op.args["owner"]
+        if single and login is None:
+            report.react('❌')
+            report.add("Nie udało się zresetować hasła. Prawdopodobnie nie masz jeszcze konta na serwerze Tryton.")
+        elif login is None:
+            report.add(f"Nie udało się zresetować hasła dla użytkownika {name}. Prawdopodobnie nie ma on jeszcze konta na serwerze Tryton.")
+        elif user is None:
+            report.add(f"Nie udało się zresetować hasła dla użytkownika {name}.")
+        else:
+            targets[login] = user
 
-        logging.info(f"Resetted password: {db['discords'][str(user.id)]}")
-        if single:
-            await ctx.message.add_reaction('📬')
-        embed=discord.Embed(title="Tryton", url="https://tryton.vlo.gda.pl", description="Sleep less, code more!", color=0x44ff00)
-        embed.add_field(name="Przywracanie dostępu do konta", value="Twoje hasła zostały zresetowane", inline=False)
-        embed.add_field(name="Nowe hasło", value=f"```{newdata[0]}```", inline=False)
-        embed.add_field(name="Nowe hasło bazy danych", value=f"```{newdata[1]}```", inline=False)
-        await user.send(embed=embed)
-        await ctx.send(f"Pomyślnie ustawiono nowe hasła dla: {db['discords'][str(user.id)]}")
-        #await ctx.author.send(f"Nowe hasło do przesyłania plików: `{newdata[0]}`\nNowe hasło do bazy danych: `{newdata[1]}`")
+    try:
+        if len(targets) == 1:
+            login = next(iter(targets))
+            results = {login: await serverManager.password_reset(login)}
+        else:
+            results = await serverManager.password_reset_many(list(targets))
     except Exception as e:
-        logging.exception(f"Password reset failed: {e}")
+        logging.exception("Password reset failed: %s", e)
+        results = {}
+
+    for login, user in targets.items():
+        if login not in results:
+            if single:
+                report.react('❌')
+                report.add("Nie udało się zresetować hasła. Prawdopodobnie nie masz jeszcze konta na serwerze Tryton.")
+            else:
+                report.add(f"Nie udało się zresetować hasła dla użytkownika {user.display_name}.")
+            continue
+        logging.info("Resetted password: %s", login, extra={"login": login, "discord_id": user.id})
         if single:
-            await ctx.message.add_reaction('❌')
-            await ctx.send("Nie udało się zresetować hasła. Prawdopodobnie nie masz jeszcze konta na serwerze Tryton.")
-        else:
-            await ctx.send(f"Nie udało się zresetować hasła dla użytkownika {user.display_name}. Prawdopodobnie nie ma on jeszcze konta na serwerze Tryton.")
+            report.react('📬')
+        report.dm(user, f"Ustawiono nowe hasła dla: {login}, ale nie udało się ich wysłać do {user.display_name}", embed=passwordEmbed(results[login]))
+        report.add(f"Pomyślnie ustawiono nowe hasła dla: {login}")
 
-async def passwordCoro(ctx):
-    if len(ctx.message.content.split()) == 1:
-        # no mentioned users - reset author's password
-        await passwordReset(ctx, ctx.author, single=True)
-    else:
-        # some mentions - check permissions
-        if not isGod(ctx.author.id):
-            await ctx.message.add_reaction('🛑')
-            await ctx.send("Normalni użytkownicy nie mogą resetować haseł innych osób.\nJeżeli próbujesz zmienić swoje hasło to użyj samej komendy bez oznaczania nikogo.")
-            return
-
-        # reset by discord username
-        for user in await getMentionedUsers(ctx, db):
-            await passwordReset(ctx, user)
-
-        # reset by server username (s1, s2, etc..)
-        for user in ctx.message.content.split()[1:]:
-            if "@" not in user and user.lower() != "all":
-                found = False
-                for i in db["discords"]:
-                    if db["discords"][i]==user:
-                        found = True
-                        res = await bot.fetch_user(int(i))
-                        await passwordReset(ctx, res)
-                        break
-                if not found:
-                    await ctx.message.add_reaction('⚠')
-                    await ctx.send(f"Użytkownik {user} nie istnieje.")
-
-    await ctx.message.remove_reaction('⌛', bot.user)
+    journal.done(ops)
 
 
 @commands.cooldown(1,10)
@@ -272,114 +475,350 @@ async def passwordCoro(ctx):
 async def whois(ctx):
     """ Identify discord user by server username and vice versa """
     if not isGod(ctx.author.id):
-        await ctx.message.add_reaction('🛑')
-        await ctx.send("Nie dla psa! Dla Adminów to!")
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
         return
 
-    await ctx.message.add_reaction('⌛')
-    await secondQueue.addJob(whoisCoro(ctx))
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, whoisCoro(ctx), priority=READ, shared=True)
 
 async def whoisCoro(ctx):
+    report = outbox.report(ctx)
     # check by discord username
-    for user in await getMentionedUsers(ctx, db):
+    for user in await getMentionedUsers(ctx):
         try:
-            nick = db["discords"][str(user.id)]
+            nick = registry.login_of(user.id)
+            if nick is None:
+                raise KeyError(user.id)
             perm="👑 Admin" if isGod(user.id) else "👨 Użytkownik"
             embed=discord.Embed(title=user.display_name, url=f"https://tryton.vlo.gda.pl/u/{nick}", description=perm)
             embed.add_field(name="Login na serwerze:", value=nick, inline=False)
             embed.add_field(name="Baza danych:", value=f"db{nick}", inline=False)
-            await ctx.send(embed=embed)
+            embed.add_field(name="Próg limitu miejsca:", value=registry.tier_of(nick) or "domyślny", inline=False)
+            report.embed(embed)
         except Exception as e:
-            logging.exception(f"Whois lookup failed: {e}")
-            await ctx.message.add_reaction('⚠')
-            await ctx.send(f"Użytkownik {user.display_name} nie posiada konta na serwerze.")
+            logging.exception("Whois lookup failed: %s", e, extra={"discord_id": user.id})
+            report.react('⚠')
+            report.add(f"Użytkownik {user.display_name} nie posiada konta na serwerze.")
 
     # Check by server username (s1, s2, etc..)
     for user in ctx.message.content.split()[1:]:
         if "@" not in user and user.lower() != "all":
-            found = False
-            for i in db["discords"]:
-                if db["discords"][i]==user:
-                    res = await bot.fetch_user(int(i))
-                    perm="👑 Admin" if isGod(i) else "👨 Użytkownik"
-                    embed=discord.Embed(title=res.display_name, url=f"https://tryton.vlo.gda.pl/u/{user}", description=perm)
-                    embed.add_field(name="Login na serwerze:", value=user, inline=False)
-                    embed.add_field(name="Baza danych:", value=f"db{user}", inline=False)
-                    await ctx.send(embed=embed)
-                    found=True
-                    break
-            if not found:
-                await ctx.message.add_reaction('⚠')
-                await ctx.send(f"Użytkownik {user} nie istnieje.")
-
-    await ctx.message.remove_reaction('⌛', bot.user)
+            owner = registry.owner_of(user)
+            if owner:
+                res = await userCache.get(owner)
+                perm="👑 Admin" if isGod(owner) else "👨 Użytkownik"
+                embed=discord.Embed(title=res.display_name, url=f"https://tryton.vlo.gda.pl/u/{user}", description=perm)
+                embed.add_field(name="Login na serwerze:", value=user, inline=False)
+                embed.add_field(name="Baza danych:", value=f"db{user}", inline=False)
+                embed.add_field(name="Próg limitu miejsca:", value=registry.tier_of(user) or "domyślny", inline=False)
+                report.embed(embed)
+            else:
+                report.react('⚠')
+                report.add(f"Użytkownik {user} nie istnieje.")
+
+    report.finish(bot.user)
 
 @commands.cooldown(1,10)
 @bot.command(help="Sprawdza, które konto należy do Ciebie")
 async def whoami(ctx):
     """ Check which account is owned by user """
 
-    await ctx.message.add_reaction('⌛')
-    await secondQueue.addJob(whoamiCoro(ctx))
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, whoamiCoro(ctx), priority=INTERACTIVE, shared=True)
 
 async def whoamiCoro(ctx):
     # check by author id
     user=ctx.author
     try:
-        nick = db["discords"][str(user.id)]
+        nick = registry.login_of(user.id)
+        if nick is None:
+            raise KeyError(user.id)
         perm="👑 Admin" if isGod(user.id) else "👨 Użytkownik"
         embed=discord.Embed(title=ctx.author.display_name, url=f"https://tryton.vlo.gda.pl/u/{nick}", description=perm)
         embed.add_field(name="Login na serwerze:", value=nick, inline=False)
         embed.add_field(name="Baza danych:", value=f"db{nick}", inline=False)
         embed.set_footer(text="Jeśli zapomniałeś swoich haseł, wpisz $password")
-        await ctx.send(embed=embed)
+        outbox.send(ctx, embed=embed)
     except Exception as e:
-        logging.exception(f"Whoami does not know who are You: {e}")
-        await ctx.message.add_reaction('❌')
-        await ctx.send(f"Nie utworzono dla Ciebie żadnego konta. Jeśli chcesz posiadać konto, skontaktuj się z administracją.")
+        logging.exception("Whoami does not know who are You: %s", e, extra={"discord_id": user.id})
+        outbox.react(ctx.message, '❌')
+        outbox.send(ctx, f"Nie utworzono dla Ciebie żadnego konta. Jeśli chcesz posiadać konto, skontaktuj się z administracją.")
 
-    await ctx.message.remove_reaction('⌛', bot.user)
+    outbox.unreact(ctx.message, '⌛', bot.user)
 
 @commands.cooldown(1,10)
 @bot.command(help="Pokazuje pełną listę użytkowników")
 async def users(ctx):
     """ Show full users list """
     if not isGod(ctx.author.id):
-        await ctx.message.add_reaction('🛑')
-        await ctx.send("Nie dla psa! Dla Adminów to!")
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
         return
-    await ctx.message.add_reaction('⌛')
-    await secondQueue.addJob(usersCoro(ctx))
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, usersCoro(ctx), priority=READ, shared=True)
 
 async def usersCoro(ctx):
     em=discord.Embed(title="Wykaz użytkowników",description="Oto wszyscy zarejestrowani na serwerze Tryton:")
     fields=0
-    for i in db["discords"]:
-        res = await bot.fetch_user(int(i))
-        login=db["discords"][str(i)]
-        em.add_field(name=res.display_name,value=f"https://tryton.vlo.gda.pl/u/{login}",inline=False)
+    discords = registry.discords()
+    resolved = await userCache.get_many(list(discords))
+    for res, login in zip(resolved, discords.values()):
+        name = res.display_name if res else "(nieznany użytkownik)"
+        em.add_field(name=name,value=f"https://tryton.vlo.gda.pl/u/{login}",inline=False)
         fields+=1
         if fields>=25:
-            await ctx.send(embed=em)
+            outbox.send(ctx, embed=em)
             em=discord.Embed()
             fields=0
-    await ctx.send(embed=em)
-    await ctx.message.remove_reaction('⌛', bot.user)
+    outbox.send(ctx, embed=em)
+    outbox.unreact(ctx.message, '⌛', bot.user)
+
+@commands.cooldown(1,10)
+@bot.command(help="Przenosi konta do innego progu limitu miejsca na dysku")
+async def tier(ctx):
+    """ Move accounts to quota tier """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+
+    words = ctx.message.content.split()[1:]
+    tiers = serverManager.userapi.quota_tiers
+    if not words or words[0] not in tiers:
+        outbox.react(ctx.message, '⚠')
+        outbox.send(ctx, f"Użycie: `$tier <próg> <użytkownicy>`\nDostępne progi: {', '.join(tiers) or 'brak'}")
+        return
+
+    outbox.react(ctx.message, '⌛')
+    ops = journal.begin("tier", tierTargets(ctx, words[0]))
+    await enqueue(ctx, mainQueue, tierCoro(ctx, ops), keys=operationKeys(ops), ops=ops)
+
+def tierTargets(ctx, tier):
+    words = ctx.message.content.split()[2:]
+    targets = []
+    if [word.lower() for word in words] == ["all"]:
+        targets.extend({"login": login, "tier": tier} for login in registry)
+
+    # by discord username
+    users = list(ctx.message.mentions)
+    for rank in ctx.message.role_mentions:
+        users.extend(rank.members)
+    targets.extend({"login": registry.login_of(user.id), "user": user.display_name, "tier": tier} for user in users)
+
+    # by server username (s1, s2, etc..)
+    for word in words:
+        if "@" not in word and word.lower() != "all":
+            targets.append({"login": word, "tier": tier})
+    return targets
+
+async def tierCoro(ctx, ops):
+    report = outbox.report(ctx)
+    await setTiers(report, ops)
+    report.finish(bot.user)
+
+async def setTiers(report, ops):
+    """ Move accounts of journal operations to their quota tiers, setquota can be safely repeated """
+    tiers = {}
+    for op in ops:
+        login = op.args["login"]
+        if login is None:
+            report.add(f"Użytkownik {op.args['user']} nie posiada konta na serwerze.")
+        elif login not in registry:
+            # account could be removed while the job was waiting
+            report.react('⚠')
+            report.add(f"Użytkownik {login} nie istnieje.")
+        else:
+            tiers.setdefault(op.args["tier"], set()).add(login)
+
+    for tier, logins in tiers.items():
+        try:
+            await serverManager.set_tier(sorted(logins), tier)
+            logging.info("Moved %d users to quota tier %s", len(logins), tier)
+            report.add(f"Przeniesiono kont do progu {tier}: {len(logins)}")
+        except Exception as e:
+            logging.exception("Changing quota tier failed: %s", e)
+            report.react('❌')
+            report.add("Nie udało się zmienić limitów miejsca na dysku.")
+
+    journal.done(ops)
+
+@commands.cooldown(1,10)
+@bot.command(help="Pokazuje, kto zajmuje najwięcej miejsca na dysku")
+async def usage(ctx):
+    """ Show top disk space consumers """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, usageCoro(ctx), priority=READ, shared=True)
+
+def formatSize(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+async def usageCoro(ctx):
+    if usageCache.updated is None:
+        outbox.send(ctx, "Zajętość dysku nie została jeszcze policzona, spróbuj za chwilę.")
+        outbox.unreact(ctx.message, '⌛', bot.user)
+        return
+
+    em=discord.Embed(title="Zajętość dysku", description="Konta zajmujące najwięcej miejsca:")
+    for login, size in usageCache.top(10, set(registry)):
+        em.add_field(name=login, value=formatSize(size), inline=False)
+    em.set_footer(text=f"Stan z {time.strftime('%H:%M:%S', time.localtime(usageCache.updated))}")
+    outbox.send(ctx, embed=em)
+    outbox.unreact(ctx.message, '⌛', bot.user)
+
+@commands.cooldown(1,10)
+@bot.command(help="Porównuje stan serwera z bazą kont")
+async def drift(ctx):
+    """ Show differences between server state and accounts database """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, driftCoro(ctx), priority=READ, shared=True)
+
+async def driftCoro(ctx):
+    report = outbox.report(ctx)
+    try:
+        result = await serverManager.drift()
+    except Exception as e:
+        logging.exception("Drift check failed: %s", e)
+        report.react('❌')
+        report.add("Nie udało się sprawdzić stanu serwera.")
+        report.finish(bot.user)
+        return
+
+    lines = []
+    for login, parts in sorted(result["missing"].items()):
+        lines.append(f"{login}: brakuje {', '.join(parts)}")
+    for login, parts in sorted(result["orphans"].items()):
+        lines.append(f"{login}: nieprzypisane {', '.join(parts)}")
+    for login in result["unlinked"]:
+        lines.append(f"{login}: brak właściciela na Discordzie")
+
+    if not lines:
+        report.add("Stan serwera zgadza się z bazą kont.")
+    else:
+        report.react('⚠')
+        report.add("Rozbieżności:")
+        for line in lines:
+            report.add(line)
+
+    report.finish(bot.user)
+
+@commands.cooldown(1,10)
+@bot.command(help="Pokazuje kolejkę usuwania katalogów domowych")
+async def trash(ctx):
+    """ Show home directories waiting for removal """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+    outbox.react(ctx.message, '⌛')
+    await enqueue(ctx, secondQueue, trashCoro(ctx), priority=READ, shared=True)
+
+async def trashCoro(ctx):
+    pending, running = serverManager.trash_status()
+    em=discord.Embed(title="Kosz", description="Katalogi domowe usuwane w tle")
+    em.add_field(name="Usuwane", value="\n".join(os.path.basename(p) for p in running) or "-", inline=False)
+    em.add_field(name="W kolejce", value=f"{len(pending)}", inline=False)
+    outbox.send(ctx, embed=em)
+    outbox.unreact(ctx.message, '⌛', bot.user)
+
+async def replayCoro(ops):
+    """ Finish operations interrupted by restart, users get their DMs but there's no channel to answer """
+    report = outbox.report()
+    actions = {"create": createAccounts, "remove": removeAccounts, "reset": resetPasswords, "tier": setTiers}
+    # keep the original order of operations of different kinds
+    for op, group in itertools.groupby(ops, key=lambda op: op.op):
+        group = list(group)
+        logging.info("Resuming %d interrupted %s operations", len(group), op)
+        await actions[op](report, group)
+    report.finish(bot.user)
+
+@bot.event
+async def on_ready():
+    global interrupted
+    if interrupted:
+        ops, interrupted = interrupted, []
+        await mainQueue.addJob(replayCoro(ops), keys=operationKeys(ops))
+
+@commands.cooldown(1,10)
+@bot.command(help="Wczytuje ponownie plik konfiguracyjny")
+async def reload(ctx):
+    """ Reload config file """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+
+    try:
+        changed = await reloadConfig()
+    except Exception as e:
+        logging.exception("Config reload failed: %s", e)
+        outbox.react(ctx.message, '❌')
+        outbox.send(ctx, f"Nie udało się wczytać konfiguracji, nadal używam poprzedniej: {e}")
+        return
+
+    outbox.react(ctx.message, '✅')
+    outbox.send(ctx, f"Wczytano konfigurację, zmienione sekcje: {', '.join(changed) or 'brak'}")
+
+@commands.cooldown(1,10)
+@bot.command(help="Profiluje działanie bota przez podaną liczbę sekund")
+async def profile(ctx):
+    """ Profile running bot and attach stacks in flamegraph format """
+    if not isGod(ctx.author.id):
+        outbox.react(ctx.message, '🛑')
+        outbox.send(ctx, "Nie dla psa! Dla Adminów to!")
+        return
+
+    words = ctx.message.content.split()[1:]
+    if len(words) > 1 or (words and not words[0].isdigit()):
+        outbox.react(ctx.message, '⚠')
+        outbox.send(ctx, f"Użycie: `$profile <sekundy>` (najwyżej {Profiler.MAX_SECONDS})")
+        return
+    if profiler.running:
+        outbox.react(ctx.message, '❌')
+        outbox.send(ctx, "Profilowanie już trwa, poczekaj na jego wynik.")
+        return
+
+    # not queued, so it can show what keeps the queues busy
+    outbox.react(ctx.message, '⌛')
+    summary, stacks = await profiler.run(int(words[0]) if words else 10)
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    outbox.send(ctx, f"```\n{summary[:1900]}\n```", attachment=(filename, stacks.encode()))
+    outbox.unreact(ctx.message, '⌛', bot.user)
 
 @bot.event
 async def on_command_error(ctx,error):
-    await ctx.message.add_reaction('❌')
+    outbox.react(ctx.message, '❌')
     if isinstance(error, commands.CommandOnCooldown):
-        await ctx.send("Nie spamuj! Możesz ponownie użyć tej komendy dopiero za {:.1f}s".format(error.retry_after))
+        outbox.send(ctx, "Nie spamuj! Możesz ponownie użyć tej komendy dopiero za {:.1f}s".format(error.retry_after))
     elif isinstance(error, commands.CommandNotFound):
-        await ctx.send("Nieprawidłowe polecenie. Wpisz `$help`, aby uzyskać listę dostępnych poleceń.")
+        outbox.send(ctx, "Nieprawidłowe polecenie. Wpisz `$help`, aby uzyskać listę dostępnych poleceń.")
     else:
-        await ctx.send("Wystąpił problem, proszę skontaktuj się z administracją.")
+        outbox.send(ctx, "Wystąpił problem, proszę skontaktuj się z administracją.")
 
 def main():
     # Run queues and bot
     asyncio.get_event_loop().run_until_complete(mainQueue.start())
     asyncio.get_event_loop().run_until_complete(secondQueue.start())
+    asyncio.get_event_loop().run_until_complete(usageCache.start())
+    asyncio.get_event_loop().create_task(watchConfig())
+
+    # undo half-done creations before any new account can take their names
+    global interrupted
+    interrupted = asyncio.get_event_loop().run_until_complete(serverManager.recover())
+    if "metrics" in config:
+        asyncio.get_event_loop().run_until_complete(metrics.serve(config["metrics"]["host"], int(config["metrics"]["port"])))
     asyncio.get_event_loop().run_until_complete(bot.start(TOKEN))
 
 if __name__ == "__main__":
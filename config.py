@@ -0,0 +1,98 @@
+import os
+import json
+import types
+
+class ConfigError(Exception):
+    pass
+
+# section -> keys which have to be present
+REQUIRED = {
+    "phpapi": ("service", "conf_dir", "template"),
+    "dbapi": ("sock", "host"),
+    "userapi": ("base_dir", "user_group", "samplequota", "admins"),
+    "passgen": ("wordsfile", "word_length", "extra_chars", "word_count", "extra_chars_count", "uppercase_prob", "force_length"),
+}
+
+def freeze(value):
+    """ Return read-only copy of parsed JSON """
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def validate(data):
+    """ Raise ConfigError describing the first problem found in config """
+    for section, keys in REQUIRED.items():
+        if not isinstance(data.get(section), dict):
+            raise ConfigError(f"missing section {section}")
+        for key in keys:
+            if key not in data[section]:
+                raise ConfigError(f"missing {section}.{key}")
+
+    if not isinstance(data["userapi"]["admins"], list):
+        raise ConfigError("userapi.admins has to be a list of ids")
+    try:
+        admins = [int(admin) for admin in data["userapi"]["admins"]]
+        for key in ("word_length", "word_count", "extra_chars_count"):
+            low, high = (int(value) for value in data["passgen"][key])
+            if low > high:
+                raise ConfigError(f"passgen.{key} has minimum above maximum")
+        float(data["passgen"]["uppercase_prob"])
+        int(data["passgen"]["force_length"])
+        int(data["dbapi"].get("pool_size", 4))
+        float(data["phpapi"].get("reload_delay", 2.0))
+        int(data["userapi"].get("reaper_workers", 1))
+        if "metrics" in data:
+            int(data["metrics"]["port"])
+    except (TypeError, ValueError, KeyError) as e:
+        raise ConfigError(f"invalid value: {e}")
+
+    if not admins:
+        raise ConfigError("userapi.admins is empty")
+    if not os.path.isfile(data["passgen"]["wordsfile"]):
+        raise ConfigError(f"no such file {data['passgen']['wordsfile']}")
+    base_dir = data["userapi"]["base_dir"]
+    trash_dir = data["userapi"].get("trash_dir") or os.path.join(base_dir, ".trash")
+    # trash_dir may not exist yet, it's created next to its existing parent
+    existing = trash_dir
+    while not os.path.exists(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    if os.path.exists(base_dir) and os.stat(base_dir).st_dev != os.stat(existing).st_dev:
+        raise ConfigError("userapi.trash_dir has to be on the same filesystem as userapi.base_dir")
+    for name, tier in data["userapi"].get("quota_tiers", {}).items():
+        if len(tier.get("blocks", ())) != 2 or len(tier.get("inodes", ())) != 2:
+            raise ConfigError(f"quota tier {name} needs soft and hard blocks and inodes limits")
+
+class Config:
+    """ Validated, read-only configuration.
+
+    Sections are mappings which can't be modified, so the whole config is
+    replaced at once on reload. Admins are kept as a set of int ids.
+    """
+    def __init__(self, data, path=None, mtime=None):
+        validate(data)
+        self._sections = freeze(data)
+        self.admins = frozenset(int(admin) for admin in data["userapi"]["admins"])
+        self.path = path
+        self.mtime = mtime
+
+    @staticmethod
+    def load(path="conf.json"):
+        """ Read and validate config file, raise ConfigError if it can't be used """
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path, "r") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            raise ConfigError(f"can't read {path}: {e}")
+        return Config(data, path, mtime)
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def get(self, section, default=None):
+        return self._sections.get(section, default)
@@ -0,0 +1,189 @@
+import time
+import threading
+
+from mm import PasswordGenerator, ReloadScheduler
+
+class FakeBackend:
+    """ In-process stand-in of a server backend.
+
+    State is kept in memory, the cost of real calls is simulated with
+    sleep: latency per call (process spawn, round trip) and item_latency
+    per account in batch calls.
+    """
+    def __init__(self, latency=0.0, item_latency=0.0):
+        self.latency = latency
+        self.item_latency = item_latency
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _cost(self, op, items=1):
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+        delay = self.latency + self.item_latency * items
+        if delay:
+            time.sleep(delay)
+
+class FakeReaper:
+    def status(self):
+        return [], []
+
+class FakeUserAPI(FakeBackend):
+    def __init__(self, latency=0.0, item_latency=0.0, quota_tiers=None):
+        super().__init__(latency, item_latency)
+        self.base_dir = "/nonexistent"
+        self.user_group = "mortals"
+        self.samplequota = "samplequota"
+        self.quota_tiers = quota_tiers or {"basic": {"blocks": [1000, 1100], "inodes": [0, 0]}}
+        self.reaper = FakeReaper()
+        self.users = {}     # name -> password
+        self.tiers = {}
+
+    def create_user(self, name):
+        self._cost("create_user")
+        with self._lock:
+            if name in self.users:
+                raise FileExistsError(name)
+            self.users[name] = None
+
+    def create_users(self, names):
+        self._cost("create_users", len(names))
+        failed = []
+        with self._lock:
+            for name in names:
+                if name in self.users:
+                    failed.append(name)
+                else:
+                    self.users[name] = None
+        return failed
+
+    def set_samplequota(self, names):
+        self._cost("set_samplequota")
+
+    def set_tier(self, names, tier):
+        self._cost("set_tier", len(names))
+        with self._lock:
+            for name in names:
+                self.tiers[name] = tier
+
+    def remove_user(self, name):
+        self._cost("remove_user")
+        with self._lock:
+            if self.users.pop(name, False) is False:
+                raise KeyError(name)
+
+    def set_password(self, name, password):
+        self._cost("set_password")
+        with self._lock:
+            if name not in self.users:
+                raise KeyError(name)
+            self.users[name] = password
+
+    def set_passwords(self, passwords):
+        self._cost("set_passwords", len(passwords))
+        with self._lock:
+            for name, password in passwords:
+                if name not in self.users:
+                    raise KeyError(name)
+                self.users[name] = password
+
+    def list_users(self):
+        self._cost("list_users")
+        with self._lock:
+            return set(self.users)
+
+    def list_homes(self):
+        return self.list_users()
+
+class FakeMariaDBApi(FakeBackend):
+    def __init__(self, latency=0.0, item_latency=0.0):
+        super().__init__(latency, item_latency)
+        self.host = "127.0.0.1"
+        self.sock = "/nonexistent"
+        self.users = {}
+
+    def create_user(self, name):
+        self._cost("create_user")
+        with self._lock:
+            if name in self.users:
+                raise KeyError(name)
+            self.users[name] = None
+
+    def create_users(self, names):
+        self._cost("create_users", len(names))
+        failed = []
+        with self._lock:
+            for name in names:
+                if name in self.users:
+                    failed.append(name)
+                else:
+                    self.users[name] = None
+        return failed
+
+    def remove_user(self, name):
+        self._cost("remove_user")
+        with self._lock:
+            if self.users.pop(name, False) is False:
+                raise KeyError(name)
+
+    def set_password(self, name, password):
+        self._cost("set_password")
+        with self._lock:
+            if name not in self.users:
+                raise KeyError(name)
+            self.users[name] = password
+
+    def set_passwords(self, passwords):
+        self._cost("set_passwords", len(passwords))
+        failed = []
+        with self._lock:
+            for name, password in passwords:
+                if name in self.users:
+                    self.users[name] = password
+                else:
+                    failed.append(name)
+        return failed
+
+    def list_users(self):
+        self._cost("list_users")
+        with self._lock:
+            return set(self.users)
+
+    def list_databases(self):
+        with self._lock:
+            return {"db%s" % name for name in self.users}
+
+class FakePHPPoolApi(FakeBackend):
+    def __init__(self, latency=0.0, item_latency=0.0, reload_latency=0.0, reload_delay=0.1):
+        super().__init__(latency, item_latency)
+        self.reload_latency = reload_latency
+        self.pools = set()
+        self.reloads = 0
+        self.reloader = ReloadScheduler(self.reload, reload_delay)
+
+    def create_user(self, name):
+        self._cost("create_user")
+        with self._lock:
+            self.pools.add(name)
+        self.reloader.request()
+
+    def remove_user(self, name):
+        self._cost("remove_user")
+        with self._lock:
+            if name not in self.pools:
+                raise FileNotFoundError(name)
+            self.pools.remove(name)
+        self.reloader.request()
+
+    def list_pools(self):
+        with self._lock:
+            return set(self.pools)
+
+    def reload(self):
+        time.sleep(self.reload_latency)
+        self.reloads += 1
+
+    def restart(self):
+        self.reload()
+
+def fake_passgen():
+    return PasswordGenerator(["alpha", "bravo", "delta", "gamma", "kilo", "lima", "oscar", "tango"], extra_chars_count=(2,3), force_length=12)
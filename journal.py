@@ -0,0 +1,46 @@
+import itertools
+from collections import namedtuple
+
+# op is "create" (args: owner, login), "remove" (login, user: display name of
+# mentioned owner, if any), "reset" (owner, login) or "tier" (login, tier, user)
+Operation = namedtuple("Operation", ("id", "op", "args"))
+
+class Journal:
+    """ Write-ahead journal of operations changing accounts.
+
+    Operations are recorded as plain records before they are queued and
+    forgotten only after they were finished, so the ones interrupted by
+    a restart can be finished or undone on the next start. Without store
+    records are kept nowhere and nothing survives a restart.
+    """
+    def __init__(self, store=None):
+        self.store = store
+        self._ids = itertools.count(1)
+
+    def begin(self, op, args_list):
+        """ Record operations of one kind, return list of Operation """
+        args_list = [dict(args) for args in args_list]
+        if not args_list:
+            return []
+        if self.store:
+            ids = self.store.journal_add(op, args_list)
+        else:
+            ids = [next(self._ids) for _ in args_list]
+        return [Operation(i, op, args) for i, args in zip(ids, args_list)]
+
+    def update(self, operation, **args):
+        """ Record progress of operation, e.g. login picked for new account """
+        operation.args.update(args)
+        if self.store:
+            self.store.journal_update(operation.id, operation.args)
+
+    def done(self, operations):
+        operations = list(operations)
+        if self.store and operations:
+            self.store.journal_remove([operation.id for operation in operations])
+
+    def pending(self):
+        """ Return operations left unfinished, oldest first """
+        if not self.store:
+            return []
+        return [Operation(*row) for row in self.store.journal_load()]
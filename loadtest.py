@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from bench import percentile
+from outbox import Outbox
+
+class FakeUser:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.dms = []
+
+    async def send(self, content=None, embed=None):
+        self.dms.append((time.monotonic(), content, embed))
+
+    def __str__(self):
+        return self.name
+
+class FakeRole:
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+
+class FakeMessage:
+    def __init__(self, content, author, mentions=(), role_mentions=()):
+        self.content = content
+        self.author = author
+        self.mentions = list(mentions)
+        self.role_mentions = list(role_mentions)
+        self.reactions = []
+        self.created = time.monotonic()
+        self.finished = asyncio.get_running_loop().create_future()
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+        # denied commands never get the hourglass
+        if emoji == '🛑':
+            self._finish()
+
+    async def remove_reaction(self, emoji, member):
+        if emoji == '⌛':
+            self._finish()
+
+    def _finish(self):
+        if not self.finished.done():
+            self.finished.set_result(time.monotonic())
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+
+class FakeContext:
+    def __init__(self, message):
+        self.message = message
+        self.author = message.author
+        # every command gets its own channel, so per-channel rate limits don't throttle the test
+        self.channel = FakeChannel(id(self))
+        self.sent = []
+
+    async def send(self, content=None, embed=None, file=None):
+        self.sent.append((time.monotonic(), content, embed, file))
+
+class FakeClient:
+    """ Stands in for the discord client in UserCache """
+    def __init__(self, users):
+        self.users = {user.id: user for user in users}
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id):
+        return self.users[user_id]
+
+class MeasuredOutbox(Outbox):
+    """ Outbox finishing the command also when its hourglass was never sent """
+    def unreact(self, message, emoji, member):
+        dropped = super().unreact(message, emoji, member)
+        if dropped and emoji == '⌛':
+            message._finish()
+        return dropped
+
+def writeConfig(tmp, admins):
+    with open("conf.json", "r") as f:
+        config = json.loads(f.read())
+
+    config["userapi"]["base_dir"] = os.path.join(tmp, "home")
+    config["userapi"]["admins"] = [str(admin.id) for admin in admins]
+    config["phpapi"]["conf_dir"] = os.path.join(tmp, "php")
+    config["passgen"]["wordsfile"] = os.path.abspath(config["passgen"]["wordsfile"])
+    config.pop("metrics", None)
+    os.makedirs(config["userapi"]["base_dir"])
+    os.makedirs(config["phpapi"]["conf_dir"])
+
+    path = os.path.join(tmp, "conf.json")
+    with open(path, "w") as f:
+        f.write(json.dumps(config))
+    return path
+
+class SpawnGuard(subprocess.Popen):
+    """ Fails any attempt to run a command, the test must never touch the machine it runs on """
+    spawned = []
+
+    def __init__(self, args, *rest, **kwargs):
+        SpawnGuard.spawned.append(args)
+        raise RuntimeError("loadtest tried to run %r" % (args,))
+
+def loadBot(args, tmp, admins, users):
+    """ Import bot module configured for the test with fake backends """
+    os.environ["ADMINBOT_CONF"] = writeConfig(tmp, admins)
+    os.environ["ADMINBOT_DB"] = os.path.join(tmp, "db.sqlite3")
+
+    from fakes import FakeUserAPI, FakeMariaDBApi, FakePHPPoolApi, fake_passgen
+    from mm import MortalManager
+    from usercache import UserCache
+
+    # bot builds its manager on import, the real backends would reload PHP-FPM,
+    # start the reaper, etc.
+    def fakeManager(config, registry, journal=None):
+        return MortalManager(
+            FakeUserAPI(args.latency, args.item_latency),
+            FakePHPPoolApi(args.latency, args.item_latency, args.reload_latency),
+            fake_passgen(),
+            registry=registry,
+            journal=journal,
+            dbapi=FakeMariaDBApi(args.latency, args.item_latency),
+            name_digits=4,
+        )
+    MortalManager.from_save = staticmethod(fakeManager)
+    subprocess.Popen = SpawnGuard
+
+    import bot as adminbot
+    adminbot.userCache = UserCache(FakeClient(admins + users))
+    adminbot.outbox = MeasuredOutbox(rate=args.discord_rate)
+    return adminbot
+
+async def command(adminbot, name, content, author, mentions=(), role_mentions=()):
+    """ Invoke command handler like discord.py would and return its context """
+    ctx = FakeContext(FakeMessage(content, author, mentions, role_mentions))
+    # callback skips the global cooldowns, which would throttle the whole test
+    await getattr(adminbot, name).callback(ctx)
+    return name, ctx
+
+async def burst(adminbot, jobs):
+    """ Start all commands at once and wait until every one of them is finished """
+    contexts = await asyncio.gather(*(command(adminbot, *job) for job in jobs))
+    await asyncio.gather(*(ctx.message.finished for _, ctx in contexts))
+    return contexts
+
+def outcome(ctx):
+    # commands rejected by full queue or merged into identical ones finish right away
+    if '🔁' in ctx.message.reactions:
+        return "merged"
+    if '❌' in ctx.message.reactions and any(content and "zajęty" in content for _, content, _, _ in ctx.sent):
+        return "rejected"
+    return "done"
+
+def summarize(title, contexts, elapsed):
+    """ Print latency and throughput of executed commands, rejected and merged ones are only counted """
+    byName = {}
+    for name, ctx in contexts:
+        stats = byName.setdefault(name, {"done": [], "rejected": 0, "merged": 0})
+        result = outcome(ctx)
+        if result == "done":
+            stats["done"].append(ctx.message.finished.result() - ctx.message.created)
+        else:
+            stats[result] += 1
+
+    done = sum(len(stats["done"]) for stats in byName.values())
+    print("\n%s: %d commands, %d executed in %.2fs (%.1f commands/sec)" % (title, len(contexts), done, elapsed, done / elapsed))
+    print("%-10s %6s %8s %8s %10s %10s %10s" % ("command", "done", "rejected", "merged", "p50 ms", "p99 ms", "max ms"))
+    for name, stats in sorted(byName.items()):
+        latencies = stats["done"] or [float("nan")]
+        print("%-10s %6d %8d %8d %10.1f %10.1f %10.1f" % (
+            name, len(stats["done"]), stats["rejected"], stats["merged"],
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000))
+
+async def onboarding(args, adminbot, admins, users):
+    """ Start of term: admins register whole classes while students ask who they are,
+    then everyone asks for passwords and admins look accounts up. """
+    queues = [await adminbot.mainQueue.start(), await adminbot.secondQueue.start()]
+    await asyncio.sleep(0)
+
+    classes = [users[i::args.classes] for i in range(args.classes)]
+    roles = [FakeRole("klasa%d" % i, members) for i, members in enumerate(classes)]
+
+    jobs = [("register", "$register <@&%d>" % i, random.choice(admins), (), (role,)) for i, role in enumerate(roles)]
+    jobs += [("whoami", "$whoami", user) for user in random.sample(users, len(users) // 2)]
+    random.shuffle(jobs)
+    start = time.monotonic()
+    summarize("Registration", await burst(adminbot, jobs), time.monotonic() - start)
+
+    jobs = [("password", "$password", user) for user in users]
+    jobs += [("whoami", "$whoami", user) for user in users]
+    jobs += [("whois", "$whois <@%d>" % user.id, random.choice(admins), (user,)) for user in random.sample(users, min(len(users), args.lookups))]
+    jobs += [("users", "$users", random.choice(admins)) for _ in range(len(admins))]
+    random.shuffle(jobs)
+    start = time.monotonic()
+    summarize("Onboarding", await burst(adminbot, jobs), time.monotonic() - start)
+
+    dms = sum(len(user.dms) for user in users)
+    print("\nAccounts: %d, DMs sent to students: %d" % (len(adminbot.registry), dms))
+
+    for task in queues:
+        task.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay start-of-term command bursts against the bot with fake Discord and backends")
+    parser.add_argument("--students", type=int, default=300)
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--admins", type=int, default=3)
+    parser.add_argument("--lookups", type=int, default=50, help="number of $whois commands")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds per backend call")
+    parser.add_argument("--item-latency", type=float, default=0.0002, help="seconds per account in batch calls")
+    parser.add_argument("--discord-rate", type=float, default=1000, help="Discord requests per second (the real global limit is 50)")
+    parser.add_argument("--reload-latency", type=float, default=0.05, help="seconds per PHP-FPM reload")
+    args = parser.parse_args()
+
+    admins = [FakeUser(1000 + i, "admin%d" % i) for i in range(args.admins)]
+    users = [FakeUser(100000 + i, "student%d" % i) for i in range(args.students)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        adminbot = loadBot(args, tmp, admins, users)
+        # expected failures (e.g. $whoami before registration) are logged as errors
+        logging.disable(logging.ERROR)
+        asyncio.get_event_loop().run_until_complete(onboarding(args, adminbot, admins, users))
+    assert not SpawnGuard.spawned, "commands were run: %r" % SpawnGuard.spawned
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+import functools
+import threading
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}   # label values -> value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, self._labels(key), value) for key, value in items]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.TYPE)]
+        lines += ["%s%s %s" % (name, labels, repr(float(value))) for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in items:
+            for bound, value in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", self._labels(key, [("le", repr(float(bound)))]), value))
+            samples.append((self.name + "_bucket", self._labels(key, [("le", "+Inf")]), count))
+            samples.append((self.name + "_sum", self._labels(key), total))
+            samples.append((self.name + "_count", self._labels(key), count))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), **kwargs):
+        return self._get(Histogram, name, help, labelnames, **kwargs)
+
+    def render(self):
+        """ Return all metrics in Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+backend_seconds = REGISTRY.histogram("adminbot_backend_seconds", "Duration of backend calls", ("backend", "op"))
+backend_errors = REGISTRY.counter("adminbot_backend_errors_total", "Failed backend calls", ("backend", "op"))
+
+def timed(backend):
+    """ Decorator measuring duration and errors of backend method """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                backend_errors.inc(backend=backend, op=func.__name__)
+                raise
+            finally:
+                backend_seconds.observe(time.monotonic() - start, backend=backend, op=func.__name__)
+        return wrapper
+    return decorator
+
+async def _handle(reader, writer, registry):
+    try:
+        request = await reader.readline()
+        # skip headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))).encode())
+        writer.write(body)
+        await writer.drain()
+    except Exception as e:
+        logging.warning("Metrics request failed: %s", e)
+    finally:
+        writer.close()
+
+async def serve(host="127.0.0.1", port=9464, registry=REGISTRY):
+    """ Start HTTP server exposing /metrics """
+    server = await asyncio.start_server(lambda r, w: _handle(r, w, registry), host, port)
+    logging.info("Metrics available on http://%s:%s/metrics", host, port)
+    return server
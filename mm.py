@@ -1,12 +1,29 @@
 import subprocess
+import functools
+import asyncio
 import os
 import pwd
+import grp
 import pymysql
 import logging
 import string
 import random
 import re
 import math
+import heapq
+import hashlib
+import time
+import threading
+import queue
+import contextvars
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from registry import AccountRegistry
+from journal import Journal
+from reconciler import Reconciler
+from reaper import Reaper
+from metrics import timed
 
 class PasswordGenerator:
     def __init__(self, wordlist, extra_chars='123456789', word_count=(4,5), extra_chars_count=(5,8), uppercase_prob=0.1, force_length=None):
@@ -45,12 +62,39 @@ class PasswordGenerator:
         return filter(lambda x: word_filter.match(x), wordlist)
 
 class UserAPI:
-    def __init__(self, base_dir, user_group, samplequota):
+    def __init__(self, base_dir, user_group, samplequota, trash_dir=None, reaper_workers=1, quota_tiers=None, quota_fs=None, reaper=None):
         self.base_dir = base_dir
         self.user_group = user_group
         self.samplequota = samplequota
+        self.quota_tiers = quota_tiers or {}
+        self.quota_fs = quota_fs
+        # trash has to be on the same filesystem as base_dir
+        self.trash_dir = trash_dir or os.path.join(base_dir, '.trash')
+        self.reaper = reaper or Reaper(self.trash_dir, reaper_workers)
 
+    @timed("userapi")
     def create_user(self, name):
+        self._create_account(name)
+        self.set_samplequota([name])
+
+    @timed("userapi")
+    def create_users(self, names):
+        """ Create many users, quota is applied with a single edquota call.
+
+        Returns names that could not be created.
+        """
+        failed = []
+        for name in names:
+            try:
+                self._create_account(name)
+            except Exception as e:
+                logging.error("User creation error for %s: %s", name, e, extra={"login": name})
+                failed.append(name)
+
+        self.set_samplequota([name for name in names if name not in failed])
+        return failed
+
+    def _create_account(self, name):
         home_dir = os.path.join(self.base_dir, name)
         content_dir = os.path.join(home_dir, 'content')
 
@@ -66,94 +110,338 @@ class UserAPI:
         os.mkdir(content_dir)
         os.chown(content_dir, upwd.pw_uid, upwd.pw_gid)
 
-        if self.samplequota:
-            subprocess.run(['edquota', '-p', self.samplequota, name], check=True)
+    @timed("userapi")
+    def set_samplequota(self, names):
+        if self.samplequota and names:
+            subprocess.run(['edquota', '-p', self.samplequota] + list(names), check=True)
+
+    @timed("userapi")
+    def set_tier(self, names, tier):
+        """ Apply quota tier to many users with a single setquota call """
+        limits = self.quota_tiers[tier]
+        line = "%d %d %d %d" % (limits["blocks"][0], limits["blocks"][1], limits["inodes"][0], limits["inodes"][1])
+        lines = ''.join('%s %s\n' % (name, line) for name in names)
 
+        # batch mode reads "name block-soft block-hard inode-soft inode-hard" lines
+        command = ['setquota', '-u', '-b']
+        command += [self.quota_fs] if self.quota_fs else ['-a']
+        subprocess.run(command, input=lines.encode(), check=True)
+
+    @timed("userapi")
     def remove_user(self, name):
-        subprocess.run(['userdel', '-rf', name], check=True)
+        home_dir = os.path.join(self.base_dir, name)
 
+        if not os.path.isdir(home_dir):
+            subprocess.run(['userdel', '-rf', name], check=True)
+            return
+
+        # home directory is deleted in background
+        try:
+            self.reaper.discard(home_dir)
+        except OSError as e:
+            # e.g. trash_dir on another filesystem, the user has to be removed anyway
+            logging.warning("Can't move %s to trash, removing it with the user: %s", home_dir, e, extra={"login": name})
+            subprocess.run(['userdel', '-rf', name], check=True)
+            return
+        subprocess.run(['userdel', '-f', name], check=True)
+
+    @timed("userapi")
     def set_password(self, name, password):
         subprocess.run(['chpasswd'], input=('%s:%s' % (name, password)).encode(), check=True)
 
+    @timed("userapi")
+    def list_users(self):
+        """ Return names of all system users in user_group """
+        gid = grp.getgrnam(self.user_group).gr_gid
+        return {entry.pw_name for entry in pwd.getpwall() if entry.pw_gid == gid}
+
+    @timed("userapi")
+    def list_homes(self):
+        return {entry.name for entry in os.scandir(self.base_dir) if entry.is_dir(follow_symlinks=False)}
+
+    @timed("userapi")
+    def set_passwords(self, passwords):
+        """ Set passwords of many users with a single chpasswd call """
+        lines = ''.join('%s:%s\n' % (name, password) for name, password in passwords)
+        subprocess.run(['chpasswd'], input=lines.encode(), check=True)
+
+class ConnectionPool:
+    """ Small pool of persistent database connections.
+
+    Idle connections are health-checked with ping (which reconnects them
+    if the server closed the session) before being handed out. Connections
+    that fail are dropped and replaced by new ones on the next checkout.
+    """
+    # client errors meaning the connection itself is unusable
+    LOST_CONNECTION = (2006, 2013, 2055)
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+        try:
+            conn.ping(reconnect=True)
+        except pymysql.err.Error as e:
+            logging.warning("Dropping broken database connection: %s", e)
+            self._discard(conn)
+            return self.connect()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except pymysql.err.Error as e:
+            if conn is not None:
+                if e.args and e.args[0] in self.LOST_CONNECTION:
+                    self._discard(conn)
+                    conn = None
+                else:
+                    # leave no half-done transaction behind for the next user
+                    try:
+                        conn.rollback()
+                    except pymysql.err.Error:
+                        self._discard(conn)
+                        conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def _checkin(self, conn):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(conn)
+                return
+        self._discard(conn)
+
+    def close(self):
+        """ Close idle connections, the ones in use are closed when they are returned """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
 class MariaDBApi:
-    def __init__(self, host='127.0.0.1', sock='/var/run/mysqld/mysqld.sock'):
+    def __init__(self, host='127.0.0.1', sock='/var/run/mysqld/mysqld.sock', pool_size=4):
         self.host = host
         self.sock = sock
+        self.pool = ConnectionPool(self._connect, pool_size)
 
+    def _connect(self):
+        return pymysql.connect(user='root', host=self.host, unix_socket=self.sock)
+
+    @timed("dbapi")
     def create_user(self, name):
-        conn = pymysql.connect(user='root', host=self.host, unix_socket=self.sock)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._create_user(cur, name)
+            conn.commit()
 
-        dbname = "db%s" % name
+    @timed("dbapi")
+    def create_users(self, names):
+        """ Create many users in one session, return names that failed """
+        failed = []
 
-        try:
+        with self.pool.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("CREATE USER '%s'@'%%' REQUIRE SSL;" % (name))
-                cur.execute("CREATE USER '%s'@'%s';" % (name, self.host))
-                cur.execute("CREATE DATABASE %s;" % dbname)
-                cur.execute("GRANT ALL PRIVILEGES ON %s.* TO '%s'@'%s';" % (dbname, name, self.host))
-                cur.execute("GRANT ALL PRIVILEGES ON %s.* TO '%s'@'%%';" % (dbname, name))
+                for name in names:
+                    try:
+                        self._create_user(cur, name)
+                    except pymysql.err.Error as e:
+                        logging.error("Database creation error for %s: %s", name, e, extra={"login": name})
+                        failed.append(name)
             conn.commit()
-        except:
-            raise
-        finally:
-            conn.close()
 
+        return failed
+
+    def _create_user(self, cur, name):
+        dbname = "db%s" % name
+
+        cur.execute("CREATE USER '%s'@'%%' REQUIRE SSL;" % (name))
+        cur.execute("CREATE USER '%s'@'%s';" % (name, self.host))
+        cur.execute("CREATE DATABASE %s;" % dbname)
+        cur.execute("GRANT ALL PRIVILEGES ON %s.* TO '%s'@'%s';" % (dbname, name, self.host))
+        cur.execute("GRANT ALL PRIVILEGES ON %s.* TO '%s'@'%%';" % (dbname, name))
 
-    def remove_user(self, name):
-        conn = pymysql.connect(user='root', host=self.host, unix_socket=self.sock)
 
+    @timed("dbapi")
+    def remove_user(self, name):
         dbname = "db%s" % name
 
         ex = None
 
-        with conn.cursor() as cur:
-            try:
-                cur.execute("DROP USER '%s'@'%%';" % (name))
-                cur.execute("DROP USER '%s'@'%s';" % (name, self.host))
-                conn.commit()
-            except pymysql.err.OperationalError as e:
-                ex = e
-            
-            try:
-                cur.execute("DROP DATABASE %s;" % dbname)
-                conn.commit()
-            except pymysql.err.OperationalError as e:
-                ex = e
-            
-        conn.close()
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute("DROP USER '%s'@'%%';" % (name))
+                    cur.execute("DROP USER '%s'@'%s';" % (name, self.host))
+                    conn.commit()
+                except pymysql.err.OperationalError as e:
+                    ex = e
+
+                try:
+                    cur.execute("DROP DATABASE %s;" % dbname)
+                    conn.commit()
+                except pymysql.err.OperationalError as e:
+                    ex = e
 
         if ex:
             raise ex
 
 
+    @timed("dbapi")
     def set_password(self, name, password):
-        conn = pymysql.connect(user='root', host=self.host, unix_socket=self.sock)
-
-        try:
+        with self.pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("ALTER USER '%s'@'%s' IDENTIFIED BY '%s'" % (name, self.host, password))
                 cur.execute("ALTER USER '%s'@'%%' IDENTIFIED BY '%s'" % (name, password))
                 conn.commit()
-        except:
-            raise
-        finally:
-            conn.close()
+
+    @timed("dbapi")
+    def list_users(self):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT User FROM mysql.user")
+                return {row[0] for row in cur.fetchall()}
+
+    @timed("dbapi")
+    def list_databases(self):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT schema_name FROM information_schema.schemata")
+                return {row[0] for row in cur.fetchall()}
+
+    @timed("dbapi")
+    def set_passwords(self, passwords):
+        """ Set passwords of many users in one session, return names that failed """
+        failed = []
+
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                for name, password in passwords:
+                    try:
+                        cur.execute("ALTER USER '%s'@'%s' IDENTIFIED BY '%s'" % (name, self.host, password))
+                        cur.execute("ALTER USER '%s'@'%%' IDENTIFIED BY '%s'" % (name, password))
+                    except pymysql.err.OperationalError as e:
+                        logging.error("Database password reset error for %s: %s", name, e, extra={"login": name})
+                        failed.append(name)
+            conn.commit()
+
+        return failed
+
+class ReloadScheduler:
+    """ Debounces reload requests.
+
+    The first request starts a timer, requests coming in before it fires
+    are batched into the same single call of the reload function.
+    """
+    def __init__(self, reload, delay=2.0):
+        self.reload = reload
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def request(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._fire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Run pending reload right now """
+        with self._lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+        self._fire()
+
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.reload()
+        except Exception as e:
+            logging.error("Reload error: %s", e)
 
 class PHPPoolApi:
-    def __init__(self, confdir, template, service):
+    def __init__(self, confdir, template, service, reload_delay=2.0):
         self.confdir = confdir
         self.template = template
         self.service = service
+        self.reloader = ReloadScheduler(self.reload_if_changed, reload_delay)
+        # reload pending before the last exit was lost with its timer, so it's
+        # unknown whether the running service has loaded configs on disk
+        self._loaded_digest = None
+        self.reloader.request()
 
+    @timed("phpapi")
     def create_user(self, name):
         confpath = os.path.join(self.confdir, "%s.conf" % name)
         with open(confpath, "w") as conffile:
             conffile.write(self.template.format(name))
+        self.reloader.request()
 
+    @timed("phpapi")
     def remove_user(self, name):
         confpath = os.path.join(self.confdir, "%s.conf" % name)
         os.remove(confpath)
+        self.reloader.request()
+
+    @timed("phpapi")
+    def list_pools(self):
+        return {entry.name[:-len(".conf")] for entry in os.scandir(self.confdir) if entry.name.endswith(".conf")}
+
+    def conf_digest(self):
+        """ Return hash of all pool configs in confdir """
+        digest = hashlib.sha1()
+        try:
+            entries = sorted(e.name for e in os.scandir(self.confdir) if e.name.endswith(".conf"))
+        except FileNotFoundError:
+            return None
+        for entry in entries:
+            with open(os.path.join(self.confdir, entry), "rb") as conffile:
+                digest.update(entry.encode() + b"\0" + conffile.read() + b"\0")
+        return digest.hexdigest()
+
+    def reload_if_changed(self):
+        digest = self.conf_digest()
+        if digest == self._loaded_digest:
+            logging.info("PHP pools unchanged, skipping reload.")
+            return
+        self.reload()
+        self._loaded_digest = digest
 
+    @timed("phpapi")
+    def reload(self):
+        """ Gracefully reload pools without dropping running requests """
+        subprocess.run(['systemctl', 'reload', self.service], check=True)
+
+    @timed("phpapi")
     def restart(self):
         subprocess.run(['systemctl', 'restart', self.service], check=True)
 
@@ -162,12 +450,79 @@ class UnsafeNameError(Exception):
     def __init__(self, name):
         self.name = name
 
+class NoFreeNameError(Exception):
+    pass
+
+class NameAllocator:
+    """ Hands out the lowest free names (s1, s2, ...).
+
+    Free numbers below the high-water mark are kept in a min-heap, numbers
+    above it were never used. Allocation and release cost O(log n).
+    """
+    def __init__(self, used=(), limit=1000, prefix="s"):
+        self.limit = limit
+        self.prefix = prefix
+        self._lock = threading.Lock()
+
+        taken = set()
+        for name in used:
+            number = self._number(name)
+            if number is not None:
+                taken.add(number)
+
+        self._high = max(taken) + 1 if taken else 1
+        self._free = [i for i in range(1, self._high) if i not in taken]
+        heapq.heapify(self._free)
+        self._free_set = set(self._free)
+
+    def _number(self, name):
+        if name.startswith(self.prefix) and name[len(self.prefix):].isdigit():
+            return int(name[len(self.prefix):])
+
+    def _pop(self):
+        if self._free:
+            number = heapq.heappop(self._free)
+            self._free_set.remove(number)
+        elif self._high < self.limit:
+            number = self._high
+            self._high += 1
+        else:
+            raise NoFreeNameError()
+        return "%s%d" % (self.prefix, number)
+
+    def available(self):
+        return len(self._free) + self.limit - self._high
+
+    def allocate(self):
+        with self._lock:
+            return self._pop()
+
+    def allocate_many(self, count):
+        """ Reserve a block of names for a batch, all or nothing """
+        with self._lock:
+            if count > self.available():
+                raise NoFreeNameError()
+            return [self._pop() for _ in range(count)]
+
+    def release(self, name):
+        number = self._number(name)
+        with self._lock:
+            if number is None or number >= self._high or number in self._free_set:
+                return
+            heapq.heappush(self._free, number)
+            self._free_set.add(number)
+
 class MortalManager:
-    def __init__(self, userapi, phpapi, passgen, mortals=None, dbapi=None, name_digits=3):
-        if mortals:
-            self.mortals = set(mortals)
+    def __init__(self, userapi, phpapi, passgen, registry=None, dbapi=None, name_digits=3, journal=None):
+        if registry is not None:
+            self.mortals = registry
+        else:
+            self.mortals = AccountRegistry()
+
+        if journal is not None:
+            self.journal = journal
         else:
-            self.mortals = set()
+            self.journal = Journal()
 
         if dbapi:
             self.dbapi = dbapi
@@ -175,62 +530,189 @@ class MortalManager:
             self.dbapi = MariaDBApi()
 
         self.name_digits = name_digits
+        self.names = NameAllocator(self.mortals, int(math.pow(10,self.name_digits)))
         self.phpapi = phpapi
-        self.phpapi.restart()
         self.userapi = userapi
         self.passgen = passgen
+        self.reconciler = Reconciler(self.userapi, self.dbapi, self.phpapi, self.mortals, self.is_name_safe)
+        self._stage_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stage")
         logging.info("Created Mortal Manager.")
 
     #auxiliary methods
     def get_free_name(self):
-        for i in range(1, int(math.pow(10,self.name_digits))):
-            name = "s%d" % i
-            if name not in self.mortals:
-                return name
-        
+        return self.names.allocate()
+
     def is_name_safe(self, name):
         if re.match('^(s\\d{1,%d})$' % self.name_digits, name):
             return True
 
+    def creation_stages(self):
+        """ Return stage -> (dependencies, action, compensation) of mortal creation """
+        return {
+            "user": ((), self.userapi.create_user, self.userapi.remove_user),
+            "database": ((), self.dbapi.create_user, self.dbapi.remove_user),
+            # pool config points into the home directory
+            "pool": (("user",), self.phpapi.create_user, self.phpapi.remove_user),
+        }
+
+    def run_stages(self, name, stages):
+        """ Run stages concurrently as soon as their dependencies are done.
+
+        If any stage fails, no new stages are started and the finished ones
+        are compensated in reverse order, then the first error is raised.
+        """
+        waiting = dict(stages)
+        running = {}    # future -> (stage, start time)
+        finished = []
+        error = None
+
+        while True:
+            if error is None:
+                for stage, (deps, action, _) in list(waiting.items()):
+                    if all(dep in finished for dep in deps):
+                        future = self._stage_pool.submit(contextvars.copy_context().run, action, name)
+                        running[future] = (stage, time.monotonic())
+                        del waiting[stage]
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, started = running.pop(future)
+                fields = {"login": name, "stage": stage, "duration": time.monotonic() - started}
+                try:
+                    future.result()
+                    finished.append(stage)
+                    logging.debug("Stage %s of %s done", stage, name, extra=fields)
+                except Exception as e:
+                    logging.error("Stage %s of %s failed: %s", stage, name, e, extra=fields)
+                    if error is None:
+                        error = e
+
+        if error is not None:
+            for stage in reversed(finished):
+                try:
+                    stages[stage][2](name)
+                except Exception as e:
+                    logging.error("Compensation of stage %s of %s failed: %s", stage, name, e, extra={"login": name, "stage": stage})
+            raise error
+
     #management methods
-    def create_mortal(self):
+    def create_mortal(self, owner=None, op=None):
+        """ Create mortal linked to discord user owner, return its name or None.
+
+        Name is written to the journal operation before anything is created,
+        so leftovers of interrupted creation can be found after restart.
+        """
+        # allocated name is not handed out again until released
         name = self.get_free_name()
-        logging.info("Creating mortal %s" % name)
-        self.remove_mortal(name)
+        logging.info("Creating mortal %s", name, extra={"login": name})
+        if op is not None:
+            self.journal.update(op, login=name)
+        if not self.reconciler.is_clean(name):
+            self.remove_mortal(name)
 
         try:
-            self.userapi.create_user(name)
-            self.dbapi.create_user(name)
-            self.phpapi.create_user(name)
-            self.phpapi.restart()
+            self.run_stages(name, self.creation_stages())
         except Exception as e:
-            logging.error("Mortal creation error: "+str(e))
-            self.remove_mortal(name)
+            logging.error("Mortal creation error: %s", e, extra={"login": name})
+            # stages were compensated, but snapshot doesn't know what is left
+            self.reconciler.invalidate()
+            self.names.release(name)
             return
-        
-        self.mortals.add(name)
+
+        self.mortals.add_mortal(name)
+        if owner is not None:
+            self.mortals.link(owner, name)
+        self.reconciler.mark_created(name)
         return name
 
+    def create_mortals(self, count, owners=None, ops=None):
+        """ Create many mortals at once, with their initial passwords.
+
+        Every stage (system users, databases, PHP pools, passwords) is run
+        for the whole batch, system users and databases concurrently.
+        Mortals that fail at any stage are removed. The i-th mortal is
+        linked to owners[i] and its name written to journal operation ops[i].
+        Returns list of (name, (userpass, dbpass)).
+        """
+        names = self.names.allocate_many(count)
+        logging.info("Creating mortals %s", ", ".join(names))
+        for op, name in zip(ops or (), names):
+            self.journal.update(op, login=name)
+        for name in names:
+            if not self.reconciler.is_clean(name):
+                self.remove_mortal(name)
+
+        failed = set()
+        def alive():
+            return [name for name in names if name not in failed]
+
+        try:
+            users = self._stage_pool.submit(contextvars.copy_context().run, self.userapi.create_users, names)
+            databases = self._stage_pool.submit(contextvars.copy_context().run, self.dbapi.create_users, names)
+            failed.update(users.result())
+            failed.update(databases.result())
+            for name in alive():
+                try:
+                    self.phpapi.create_user(name)
+                except Exception as e:
+                    logging.error("PHP pool creation error for %s: %s", name, e, extra={"login": name, "stage": "pool"})
+                    failed.add(name)
+            passwords = self.password_reset_many(alive())
+        except Exception as e:
+            logging.error("Mortals creation error: %s", e)
+            failed.update(names)
+            passwords = {}
+
+        failed.update(name for name in names if name not in passwords)
+
+        owners = dict(zip(names, owners or ()))
+        created = []
+        for name in names:
+            if name in failed:
+                self.remove_mortal(name)
+                self.names.release(name)
+            else:
+                self.mortals.add_mortal(name)
+                if name in owners:
+                    self.mortals.link(owners[name], name)
+                self.reconciler.mark_created(name)
+                created.append((name, passwords[name]))
+        return created
+
     def remove_mortal(self, name):
         if not self.is_name_safe(name):
             raise UnsafeNameError(name)
 
-        logging.info("Attempting to raze %s's earthly possessions." % name)
-        if name in self.mortals:
-            self.mortals.remove(name)
+        logging.info("Attempting to raze %s's earthly possessions.", name, extra={"login": name})
+        owned = name in self.mortals
+        if owned:
+            self.mortals.remove_mortal(name)
 
+        clean = True
         try:
             self.userapi.remove_user(name)
         except:
-            pass
+            clean = False
         try:
             self.dbapi.remove_user(name)
         except:
-            pass
+            clean = False
         try:
             self.phpapi.remove_user(name)
         except:
-            pass
+            clean = False
+
+        if clean:
+            self.reconciler.mark_removed(name)
+        else:
+            # some parts were probably already gone, look again next time
+            self.reconciler.invalidate()
+
+        # name can be reused only after everything is gone
+        if owned:
+            self.names.release(name)
 
     def password_reset(self, name):
         if not self.is_name_safe(name):
@@ -244,29 +726,161 @@ class MortalManager:
 
         return userpass, dbpass
 
+    def password_reset_many(self, names):
+        """ Reset passwords of many mortals at once.
+
+        Returns dict name -> (userpass, dbpass) of successfully reset mortals.
+        """
+        for name in names:
+            if not self.is_name_safe(name):
+                raise UnsafeNameError(name)
+
+        passwords = {name: (self.passgen.generate(), self.passgen.generate()) for name in names}
+        if not passwords:
+            return passwords
+
+        try:
+            self.userapi.set_passwords([(name, pair[0]) for name, pair in passwords.items()])
+        except Exception as e:
+            # chpasswd does not tell which line failed - find it one by one
+            logging.error("Batch password reset error: %s", e)
+            for name in list(passwords):
+                try:
+                    self.userapi.set_password(name, passwords[name][0])
+                except Exception as e:
+                    logging.error("Password reset error for %s: %s", name, e, extra={"login": name})
+                    del passwords[name]
+
+        for name in self.dbapi.set_passwords([(name, pair[1]) for name, pair in passwords.items()]):
+            del passwords[name]
+
+        return passwords
+
+
+    def set_tier(self, names, tier):
+        """ Move mortals to quota tier """
+        if tier not in self.userapi.quota_tiers:
+            raise KeyError(tier)
+        for name in names:
+            if not self.is_name_safe(name):
+                raise UnsafeNameError(name)
+
+        if names:
+            self.userapi.set_tier(names, tier)
+            self.mortals.set_tier(names, tier)
+
+    def drift(self):
+        """ Compare actual server state with the registry """
+        return self.reconciler.drift()
+
+    def recover(self):
+        """ Undo account creations interrupted by restart.
+
+        Returns unfinished journal operations, all of them safe to be run
+        again: leftovers of creations which didn't finish are removed, so
+        their names are free again, and accounts which were created but
+        not linked yet are linked to their owners.
+        """
+        operations = self.journal.pending()
+        for op in operations:
+            name = op.args.get("login")
+            if op.op != "create" or not name:
+                continue
+            if name in self.mortals:
+                owner = op.args.get("owner")
+                if self.mortals.owner_of(name) is None and owner and self.mortals.login_of(owner) is None:
+                    logging.info("Linking recovered mortal %s", name, extra={"login": name, "discord_id": owner})
+                    self.mortals.link(owner, name)
+            else:
+                logging.info("Removing leftovers of interrupted creation of %s", name, extra={"login": name})
+                self.remove_mortal(name)
+                self.journal.update(op, login=None)
+        return operations
 
     #config methods
     @staticmethod
-    def from_save(config, db):
-        dbapi = MariaDBApi(config["dbapi"]['host'], config["dbapi"]['sock'])
-        userapi = UserAPI(config["userapi"]["base_dir"], config["userapi"]["user_group"], config["userapi"]["samplequota"])
-        phpapi = PHPPoolApi(config["phpapi"]["conf_dir"], config["phpapi"]["template"], config["phpapi"]["service"])
+    def build_dbapi(section):
+        return MariaDBApi(section['host'], section['sock'], int(section.get('pool_size', 4)))
 
-        with open(config["passgen"]["wordsfile"], "r") as wordsfile:
+    @staticmethod
+    def build_userapi(section, reaper=None):
+        return UserAPI(
+        section["base_dir"],
+        section["user_group"],
+        section["samplequota"],
+        trash_dir = section.get("trash_dir"),
+        reaper_workers = int(section.get("reaper_workers", 1)),
+        quota_tiers = section.get("quota_tiers"),
+        quota_fs = section.get("quota_fs"),
+        reaper = reaper
+        )
+
+    @staticmethod
+    def build_phpapi(section):
+        return PHPPoolApi(section["conf_dir"], section["template"], section["service"], float(section.get("reload_delay", 2.0)))
+
+    @staticmethod
+    def build_passgen(section):
+        with open(section["wordsfile"], "r") as wordsfile:
             wordlist = list(PasswordGenerator.filter_words(wordsfile.read().split('\n')))
 
-        wordlist = list(PasswordGenerator.filter_words(wordlist, tuple(config["passgen"]["word_length"])))
+        wordlist = list(PasswordGenerator.filter_words(wordlist, tuple(section["word_length"])))
 
-        passgen = PasswordGenerator(
+        return PasswordGenerator(
         wordlist, 
-        extra_chars = config["passgen"]["extra_chars"],
-        word_count = tuple(config["passgen"]["word_count"]),
-        extra_chars_count = tuple(config["passgen"]["extra_chars_count"]),
-        uppercase_prob = float(config["passgen"]["uppercase_prob"]),
-        force_length = int(config["passgen"]["force_length"])
+        extra_chars = section["extra_chars"],
+        word_count = tuple(section["word_count"]),
+        extra_chars_count = tuple(section["extra_chars_count"]),
+        uppercase_prob = float(section["uppercase_prob"]),
+        force_length = int(section["force_length"])
         )
 
-        return MortalManager(userapi, phpapi, passgen, mortals=db['mortals'], dbapi=dbapi)
+    @staticmethod
+    def from_save(config, registry, journal=None):
+        dbapi = MortalManager.build_dbapi(config["dbapi"])
+        userapi = MortalManager.build_userapi(config["userapi"])
+        phpapi = MortalManager.build_phpapi(config["phpapi"])
+        passgen = MortalManager.build_passgen(config["passgen"])
+        return MortalManager(userapi, phpapi, passgen, registry=registry, dbapi=dbapi, journal=journal)
+
+    def reconfigure(self, old, new):
+        """ Rebuild only the parts whose config sections changed, return their names.
+
+        All changed parts are built first and swapped only if every one of
+        them could be built, so a failed reload leaves the old ones in use.
+        Parts being replaced finish their pending work: PHP-FPM reload is
+        run right away, database connections are closed once they are
+        returned and removed home directories keep being deleted if the
+        trash stays the same.
+        """
+        parts = {}
+        if old["passgen"] != new["passgen"]:
+            parts["passgen"] = MortalManager.build_passgen(new["passgen"])
+        if old["dbapi"] != new["dbapi"]:
+            parts["dbapi"] = MortalManager.build_dbapi(new["dbapi"])
+        if old["phpapi"] != new["phpapi"]:
+            parts["phpapi"] = MortalManager.build_phpapi(new["phpapi"])
+
+        # admins are not used by the api
+        sections = [{key: value for key, value in config["userapi"].items() if key != "admins"} for config in (old, new)]
+        if sections[0] != sections[1]:
+            # the same trash keeps its reaper, so directories aren't queued twice
+            reaper = None
+            if all(sections[0].get(key) == sections[1].get(key) for key in ("base_dir", "trash_dir", "reaper_workers")):
+                reaper = self.userapi.reaper
+            # built last, new reaper starts threads and creates trash_dir
+            parts["userapi"] = MortalManager.build_userapi(new["userapi"], reaper)
+
+        if "phpapi" in parts:
+            self.phpapi.reloader.flush()
+        replaced = {name: getattr(self, name) for name in parts}
+        for name, part in parts.items():
+            setattr(self, name, part)
+        if set(parts) & {"dbapi", "userapi", "phpapi"}:
+            self.reconciler = Reconciler(self.userapi, self.dbapi, self.phpapi, self.mortals, self.is_name_safe)
+        if "dbapi" in replaced:
+            replaced["dbapi"].pool.close()
+        return [name for name in ("passgen", "dbapi", "userapi", "phpapi") if name in parts]
 
     def dump_save(self):
         config = {
@@ -282,3 +896,57 @@ class MortalManager:
             }
         }
         return config
+
+class AsyncMortalManager:
+    """ Asyncio facade for MortalManager.
+
+    Management methods block on subprocesses and database connections,
+    so they are run in a bounded thread pool to keep the event loop free.
+    Other attributes are passed through to the wrapped manager.
+    """
+    def __init__(self, manager, max_workers=4):
+        self.manager = manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mortal")
+
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # logs of the thread belong to the job which called it
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, functools.partial(context.run, func, *args, **kwargs))
+
+    #management methods
+    async def create_mortal(self, owner=None, op=None):
+        return await self._run(self.manager.create_mortal, owner, op)
+
+    async def create_mortals(self, count, owners=None, ops=None):
+        return await self._run(self.manager.create_mortals, count, owners, ops)
+
+    async def remove_mortal(self, name):
+        return await self._run(self.manager.remove_mortal, name)
+
+    async def password_reset(self, name):
+        return await self._run(self.manager.password_reset, name)
+
+    async def password_reset_many(self, names):
+        return await self._run(self.manager.password_reset_many, names)
+
+    async def set_tier(self, names, tier):
+        return await self._run(self.manager.set_tier, names, tier)
+
+    async def drift(self):
+        return await self._run(self.manager.drift)
+
+    async def recover(self):
+        return await self._run(self.manager.recover)
+
+    async def reconfigure(self, old, new):
+        return await self._run(self.manager.reconfigure, old, new)
+
+    def trash_status(self):
+        return self.manager.userapi.reaper.status()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,201 @@
+import io
+import time
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from metrics import REGISTRY
+
+outbox_pending = REGISTRY.gauge("adminbot_outbox_pending", "Discord requests waiting for delivery")
+outbox_retries = REGISTRY.counter("adminbot_outbox_retries_total", "Retried Discord requests", ("kind",))
+outbox_failures = REGISTRY.counter("adminbot_outbox_failures_total", "Discord requests given up on", ("kind",))
+
+class Bucket:
+    """ Token bucket allowing rate requests per given seconds """
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """ Hold all requests of the bucket, e.g. after 429 response """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def _channel(dest):
+    # contexts and messages are limited by their channel, users by their DM channel
+    channel = getattr(dest, "channel", dest)
+    return getattr(channel, "id", id(channel))
+
+class Outbox:
+    """ Central dispatcher of outgoing Discord requests.
+
+    Requests are queued per route (kind of request and channel), every
+    route is drained by its own task respecting its rate limit bucket and
+    the global one, so messages in one channel keep their order while DMs
+    to different users are delivered concurrently. Failed requests are
+    retried with exponential backoff, 429 responses hold the whole route
+    for the time Discord asks for. Hourglass removed before it was even
+    added costs no request at all.
+
+    Nothing here has to be awaited, so jobs changing the server never
+    wait for chat.
+    """
+    LIMITS = {"send": (5, 5.0), "react": (1, 0.25)}
+
+    def __init__(self, rate=50, per=1.0, retries=3, backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self._global = Bucket(rate, per)
+        self._buckets = {}  # route -> Bucket
+        self._routes = {}   # route -> deque of waiting requests
+
+    def send(self, dest, content=None, embed=None, on_error=None, attachment=None):
+        """ Send message to channel of the context or DM to the user, attachment is (filename, bytes) """
+        if attachment is None:
+            call = lambda: dest.send(content, embed=embed)
+        else:
+            # discord.File is consumed by sending, every attempt needs a new one
+            filename, data = attachment
+            call = lambda: dest.send(content, embed=embed, file=discord.File(io.BytesIO(data), filename))
+        self._post(("send", _channel(dest)), call, on_error)
+
+    def react(self, message, emoji):
+        self._post(("react", _channel(message)), lambda: message.add_reaction(emoji), tag=(id(message), emoji))
+
+    def unreact(self, message, emoji, member):
+        """ Remove own reaction, return True if it was still waiting and won't be added at all """
+        route = ("react", _channel(message))
+        queue = self._routes.get(route, ())
+        for item in queue:
+            if item[2] == (id(message), emoji):
+                queue.remove(item)
+                outbox_pending.dec()
+                return True
+        self._post(route, lambda: message.remove_reaction(emoji, member))
+        return False
+
+    def report(self, ctx=None):
+        return Report(self, ctx)
+
+    def _post(self, route, call, on_error=None, tag=None):
+        queue = self._routes.get(route)
+        if queue is None:
+            queue = self._routes[route] = deque()
+            asyncio.ensure_future(self._drain(route, queue))
+        queue.append((call, on_error, tag))
+        outbox_pending.inc()
+
+    async def _drain(self, route, queue):
+        kind = route[0]
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = Bucket(*self.LIMITS[kind])
+
+        try:
+            while queue:
+                call, on_error, _ = queue.popleft()
+                outbox_pending.dec()
+                try:
+                    await self._deliver(kind, bucket, call)
+                except Exception as e:
+                    outbox_failures.inc(kind=kind)
+                    logging.warning("Discord request %s failed: %s", kind, e)
+                    if on_error:
+                        on_error(e)
+        finally:
+            del self._routes[route]
+
+    async def _deliver(self, kind, bucket, call):
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await call()
+            except discord.HTTPException as e:
+                if attempt == self.retries or (e.status != 429 and e.status < 500):
+                    raise
+                if e.status == 429:
+                    retry_after = getattr(e.response, "headers", {}).get("Retry-After")
+                    bucket.block(float(retry_after) if retry_after else self.backoff * 2 ** attempt)
+                else:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+            except (OSError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            outbox_retries.inc(kind=kind)
+
+class Report:
+    """ Collects channel messages of one command and sends them together.
+
+    Without ctx (operations resumed after restart) there is no channel to
+    answer to, the messages are only logged.
+    """
+    def __init__(self, outbox, ctx=None):
+        self.outbox = outbox
+        self.ctx = ctx
+        self.lines = []
+        self.reactions = set()
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def react(self, emoji):
+        if self.ctx is not None and emoji not in self.reactions:
+            self.reactions.add(emoji)
+            self.outbox.react(self.ctx.message, emoji)
+
+    def embed(self, embed):
+        if self.ctx is not None:
+            self.outbox.send(self.ctx, embed=embed)
+
+    def dm(self, user, failed, content=None, embed=None):
+        """ Send DM to the user, post failed message to the channel if it can't be delivered """
+        if self.ctx is None:
+            on_error = lambda _: logging.warning(failed)
+        else:
+            on_error = lambda _: self.outbox.send(self.ctx, failed)
+        self.outbox.send(user, content, embed=embed, on_error=on_error)
+
+    def flush(self):
+        if self.ctx is None:
+            for line in self.lines:
+                logging.info(line)
+            self.lines = []
+            return
+
+        # keep messages under discord's 2000 characters limit
+        message = ""
+        for line in self.lines:
+            if message and len(message) + len(line) + 1 > 1990:
+                self.outbox.send(self.ctx, message)
+                message = ""
+            message += ("\n" if message else "") + line[:1990]
+        if message:
+            self.outbox.send(self.ctx, message)
+        self.lines = []
+
+    def finish(self, member):
+        """ Send collected messages and remove the hourglass of the command """
+        self.flush()
+        if self.ctx is not None:
+            self.outbox.unreact(self.ctx.message, '⌛', member)
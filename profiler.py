@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+class Profile:
+    """ Samples collected during one profiling window """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.lags = []              # how late were the wakeups of the event loop
+        self.slow = []              # (duration, callback) running longer than slow_callback
+        self.stacks = Counter()     # collapsed stack -> samples
+        self.loop_frames = Counter()    # innermost frame of busy event loop -> samples
+        self.loop_samples = 0
+        self.jobs = {}              # job name -> [count, run time, time on event loop]
+
+    def add_job(self, job, run, steps):
+        stats = self.jobs.setdefault(job, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += run
+        stats[2] += steps
+
+    def timed(self, coro, job):
+        return _Timed(self, coro, job)
+
+    def collapsed(self):
+        """ Stacks in the collapsed format of flamegraph.pl, speedscope, etc. """
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
+
+    def summary(self, slow_threshold, top=10):
+        lines = [f"Profil z {self.seconds} s"]
+        if self.lags:
+            over = sum(lag > slow_threshold for lag in self.lags)
+            lines.append("Opóźnienie pętli: średnio %.1f ms, maks. %.1f ms, %d razy ponad %d ms" % (
+                sum(self.lags) / len(self.lags) * 1000, max(self.lags) * 1000, over, slow_threshold * 1000))
+        if self.loop_samples:
+            busy = sum(self.loop_frames.values())
+            lines.append("Pętla zajęta w %d%% z %d próbek" % (busy * 100 // self.loop_samples, self.loop_samples))
+            for frame, count in self.loop_frames.most_common(top):
+                lines.append("  %5d  %s" % (count, frame))
+
+        lines.append("Wolne wywołania (ponad %d ms): %d" % (slow_threshold * 1000, len(self.slow)))
+        for duration, callback in sorted(self.slow, reverse=True)[:top]:
+            lines.append("  %.2f s  %s" % (duration, callback[:100]))
+
+        lines.append("Zadania kolejek (liczba, czas, w tym na pętli):")
+        for job, (count, run, steps) in sorted(self.jobs.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append("  %-16s %4d %8.3f s %8.3f s" % (job, count, run, steps))
+        return "\n".join(lines)
+
+class _Timed:
+    """ Awaitable driving the job coroutine itself to measure time of its steps.
+
+    Time between resuming the coroutine and its next suspension is spent on
+    the event loop, so jobs blocking it stand out from jobs just waiting.
+    """
+    def __init__(self, profile, coro, job):
+        self.profile = profile
+        self.coro = coro
+        self.job = job
+
+    def __await__(self):
+        started = time.monotonic()
+        steps = 0.0
+        value, error = None, None
+        try:
+            while True:
+                step = time.perf_counter()
+                try:
+                    if error is None:
+                        future = self.coro.send(value)
+                    else:
+                        future = self.coro.throw(error)
+                except StopIteration as e:
+                    return e.value
+                finally:
+                    steps += time.perf_counter() - step
+                try:
+                    value, error = (yield future), None
+                except GeneratorExit:
+                    self.coro.close()
+                    raise
+                except BaseException as e:
+                    value, error = None, e
+        finally:
+            self.profile.add_job(self.job, time.monotonic() - started, steps)
+
+def _frame(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+def _callback(frame):
+    """ Return frame of Handle._run executing the callback the frame belongs to and the callback's frame """
+    while frame.f_back is not None:
+        caller = frame.f_back
+        if caller.f_code.co_name == "_run" and os.path.basename(caller.f_code.co_filename) == "events.py":
+            return caller, frame
+        frame = caller
+    return None, None
+
+class Profiler:
+    """ Profiles the running bot for a bounded window.
+
+    While it runs, a thread samples stacks of all threads, a task measures
+    how late the event loop wakes up and jobs started by the queues are
+    timed step by step. A callback seen running by consecutive samples
+    for longer than slow_callback is reported as slow, which costs far less
+    than asyncio debug mode. Only one window can run at a time, all of it
+    is switched off again afterwards.
+    """
+    MAX_SECONDS = 60
+
+    def __init__(self, queues=(), interval=0.01, lag_interval=0.05, slow_callback=0.1):
+        self.queues = queues
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self.slow_callback = slow_callback
+        self.running = False
+
+    async def run(self, seconds):
+        """ Profile for seconds (at most MAX_SECONDS), return summary and collapsed stacks """
+        profile = Profile(max(1, min(int(seconds), self.MAX_SECONDS)))
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(profile, stop, threading.get_ident()), name="profiler", daemon=True)
+
+        self.running = True
+        for queue in self.queues:
+            queue.profile = profile
+        lag = asyncio.create_task(self._watch_lag(profile))
+        sampler.start()
+        try:
+            await asyncio.sleep(profile.seconds)
+        finally:
+            stop.set()
+            lag.cancel()
+            for queue in self.queues:
+                queue.profile = None
+            # sampling takes at most one interval, don't block the loop waiting for it
+            await loop.run_in_executor(None, sampler.join)
+            self.running = False
+
+        logging.info("Profiled %d s, %d stacks sampled", profile.seconds, sum(profile.stacks.values()), extra={"duration": profile.seconds})
+        return profile.summary(self.slow_callback), profile.collapsed()
+
+    async def _watch_lag(self, profile):
+        while True:
+            expected = time.monotonic() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            profile.lags.append(max(0.0, time.monotonic() - expected))
+
+    def _sample(self, profile, stop, loop_thread):
+        me = threading.get_ident()
+        running = None  # (Handle._run frame, first seen, last seen, description) of callback on the loop
+        while not stop.wait(self.interval):
+            now = time.monotonic()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident == loop_thread:
+                    profile.loop_samples += 1
+                    # waiting in select means the loop has nothing to do
+                    if os.path.basename(frame.f_code.co_filename) != "selectors.py":
+                        profile.loop_frames[_frame(frame)] += 1
+                    # the frame object is kept alive by running, so it can't be reused by another callback
+                    handle, callback = _callback(frame)
+                    if running is not None and running[0] is not handle:
+                        self._finish_callback(profile, running)
+                        running = None
+                    if handle is not None:
+                        if running is None:
+                            description = _frame(callback) if callback is frame else "%s -> %s" % (_frame(callback), _frame(frame))
+                            running = (handle, now, now, description)
+                        else:
+                            running = running[:2] + (now,) + running[3:]
+                stack = []
+                while frame is not None:
+                    stack.append(_frame(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                profile.stacks[";".join(reversed(stack))] += 1
+        if running is not None:
+            self._finish_callback(profile, running)
+
+    def _finish_callback(self, profile, running):
+        _, first, last, description = running
+        # it started at most one interval before the first sample seeing it
+        duration = last - first + self.interval
+        if duration >= self.slow_callback:
+            profile.slow.append((duration, description))
@@ -0,0 +1,73 @@
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+
+class Reaper:
+    """ Deletes discarded directories in the background.
+
+    discard() only renames the directory into trash_dir, which is instant
+    when both are on the same filesystem. Worker threads then remove it
+    with idle I/O priority, so big home directories don't slow down
+    anything else.
+    """
+    def __init__(self, trash_dir, workers=1):
+        self.trash_dir = trash_dir
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._running = []
+
+        os.makedirs(self.trash_dir, mode=0o700, exist_ok=True)
+
+        # leftovers from previous session
+        for entry in os.scandir(self.trash_dir):
+            self._enqueue(entry.path)
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name="reaper-%d" % i, daemon=True).start()
+
+    def discard(self, path):
+        """ Move directory to trash and schedule its removal """
+        target = os.path.join(self.trash_dir, "%s.%d" % (os.path.basename(os.path.normpath(path)), time.time_ns()))
+        os.rename(path, target)
+        self._enqueue(target)
+        return target
+
+    def status(self):
+        """ Return lists of paths waiting for removal and being removed """
+        with self._lock:
+            return list(self._pending), list(self._running)
+
+    def _enqueue(self, path):
+        with self._lock:
+            self._pending.append(path)
+        self._queue.put(path)
+
+    def _command(self, path):
+        command = ['rm', '-rf', '--one-file-system', path]
+        if shutil.which('nice'):
+            command = ['nice', '-n', '19'] + command
+        if shutil.which('ionice'):
+            command = ['ionice', '-c', '3'] + command
+        return command
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            with self._lock:
+                self._pending.remove(path)
+                self._running.append(path)
+
+            started = time.monotonic()
+            try:
+                subprocess.run(self._command(path), check=True)
+                logging.info("Reaped %s in %.1fs", path, time.monotonic() - started)
+            except Exception as e:
+                logging.error("Can't remove %s: %s", path, e)
+            finally:
+                with self._lock:
+                    self._running.remove(path)
@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+
+class Snapshot:
+    """ Actual state of the server, taken with one bulk query per backend """
+    COMPONENTS = ("user", "home", "dbuser", "database", "pool")
+
+    def __init__(self, users, homes, db_users, databases, pools):
+        self.taken_at = time.monotonic()
+        self.users = set(users)
+        self.homes = set(homes)
+        self.db_users = set(db_users)
+        self.databases = set(databases)
+        self.pools = set(pools)
+
+    def components(self, name):
+        """ Return list of components existing for the name """
+        present = (
+            name in self.users,
+            name in self.homes,
+            name in self.db_users,
+            "db%s" % name in self.databases,
+            name in self.pools,
+        )
+        return [c for c, p in zip(self.COMPONENTS, present) if p]
+
+    def is_clean(self, name):
+        return not self.components(name)
+
+    def names(self):
+        return self.users | self.homes | self.db_users | self.pools | {d[2:] for d in self.databases if d.startswith("db")}
+
+class Reconciler:
+    """ Compares actual server state with the account registry.
+
+    Keeps the last snapshot, so cheap questions like "is this name clean?"
+    don't have to query every backend again. The snapshot is updated by
+    mark_created()/mark_removed() after own operations and taken again
+    once it is older than max_age seconds.
+    """
+    def __init__(self, userapi, dbapi, phpapi, registry, is_name_safe, max_age=300):
+        self.userapi = userapi
+        self.dbapi = dbapi
+        self.phpapi = phpapi
+        self.registry = registry
+        self.is_name_safe = is_name_safe
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def take(self):
+        snapshot = Snapshot(
+            self.userapi.list_users(),
+            self.userapi.list_homes(),
+            self.dbapi.list_users(),
+            self.dbapi.list_databases(),
+            self.phpapi.list_pools(),
+        )
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self):
+        """ Return last snapshot if still fresh, otherwise take a new one """
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.taken_at > self.max_age:
+            snapshot = self.take()
+        return snapshot
+
+    def is_clean(self, name):
+        """ Return True if nothing of the name exists on the server """
+        try:
+            return self.snapshot().is_clean(name)
+        except Exception as e:
+            logging.error("Can't take server snapshot: %s", e)
+            return False
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def mark_created(self, name):
+        with self._lock:
+            if self._snapshot:
+                self._snapshot.users.add(name)
+                self._snapshot.homes.add(name)
+                self._snapshot.db_users.add(name)
+                self._snapshot.databases.add("db%s" % name)
+                self._snapshot.pools.add(name)
+
+    def mark_removed(self, name):
+        with self._lock:
+            if self._snapshot:
+                self._snapshot.users.discard(name)
+                self._snapshot.homes.discard(name)
+                self._snapshot.db_users.discard(name)
+                self._snapshot.databases.discard("db%s" % name)
+                self._snapshot.pools.discard(name)
+
+    def drift(self):
+        """ Take a fresh snapshot and compare it with the registry.
+
+        Returns dict with:
+        missing - registered name -> components that don't exist
+        orphans - unregistered name -> components that exist
+        unlinked - registered names without discord owner
+        """
+        snapshot = self.take()
+        registered = set(self.registry)
+
+        missing = {}
+        for name in registered:
+            present = snapshot.components(name)
+            if len(present) != len(Snapshot.COMPONENTS):
+                missing[name] = [c for c in Snapshot.COMPONENTS if c not in present]
+
+        orphans = {}
+        for name in snapshot.names() - registered:
+            if self.is_name_safe(name):
+                orphans[name] = snapshot.components(name)
+
+        unlinked = sorted(name for name in registered if self.registry.owner_of(name) is None)
+
+        return {"missing": missing, "orphans": orphans, "unlinked": unlinked}
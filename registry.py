@@ -0,0 +1,92 @@
+import threading
+
+class AccountRegistry:
+    """ In-memory index of accounts, kept in both directions.
+
+    Holds the set of server accounts (logins) and the discord id <-> login
+    links. Every mutation updates all indexes and the backing store
+    together, so lookups are O(1) dictionary hits.
+    """
+    def __init__(self, store=None):
+        self.store = store
+        self._lock = threading.RLock()
+        self._mortals = set()
+        self._logins = {}   # discord id -> login
+        self._owners = {}   # login -> discord id
+        self._tiers = {}    # login -> quota tier
+
+        if store:
+            saved = store.load()
+            self._mortals.update(saved["mortals"])
+            self._tiers.update(saved["tiers"])
+            for discord_id, login in saved["discords"].items():
+                self._logins[discord_id] = login
+                self._owners[login] = discord_id
+
+    #lookup methods
+    def login_of(self, discord_id):
+        """ Return login owned by discord user or None """
+        return self._logins.get(str(discord_id))
+
+    def owner_of(self, login):
+        """ Return discord id (as str) owning the login or None """
+        return self._owners.get(login)
+
+    def tier_of(self, login):
+        """ Return quota tier of login, None means the default samplequota """
+        return self._tiers.get(login)
+
+    def discords(self):
+        """ Return snapshot of discord id -> login links """
+        with self._lock:
+            return dict(self._logins)
+
+    def __contains__(self, login):
+        return login in self._mortals
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._mortals))
+
+    def __len__(self):
+        return len(self._mortals)
+
+    #mutation methods
+    def add_mortal(self, login):
+        with self._lock:
+            if self.store:
+                self.store.add_mortal(login)
+            self._mortals.add(login)
+
+    def remove_mortal(self, login):
+        """ Forget login together with its discord link """
+        with self._lock:
+            if self.store:
+                self.store.remove_mortal(login)
+            self._mortals.discard(login)
+            self._tiers.pop(login, None)
+            owner = self._owners.pop(login, None)
+            if owner is not None:
+                self._logins.pop(owner, None)
+
+    def link(self, discord_id, login):
+        discord_id = str(discord_id)
+        with self._lock:
+            if self.store:
+                self.store.link(discord_id, login)
+            old = self._logins.pop(discord_id, None)
+            if old is not None:
+                self._owners.pop(old, None)
+            old_owner = self._owners.pop(login, None)
+            if old_owner is not None:
+                self._logins.pop(old_owner, None)
+            self._logins[discord_id] = login
+            self._owners[login] = discord_id
+
+    def set_tier(self, logins, tier):
+        logins = list(logins)
+        with self._lock:
+            if self.store:
+                self.store.set_tiers(logins, tier)
+            for login in logins:
+                self._tiers[login] = tier
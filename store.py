@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+class AccountStore:
+    """ Persistent storage of accounts backed by SQLite in WAL mode.
+
+    Every mutation is a single small transaction, so its cost does not
+    depend on the number of stored accounts and a crash can only lose
+    the write that was in progress.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS mortals (login TEXT PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS discords (discord_id TEXT PRIMARY KEY, login TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS tiers (login TEXT PRIMARY KEY, tier TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, args TEXT NOT NULL, created REAL NOT NULL)",
+    )
+
+    def __init__(self, path="db.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        # autocommit mode - transactions are opened explicitly in _transaction()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+
+    def _transaction(self, *statements):
+        """ Execute statements atomically, return row ids of inserted rows """
+        with self._lock:
+            cur = self._conn.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                rowids = []
+                for sql, params in statements:
+                    cur.execute(sql, params)
+                    rowids.append(cur.lastrowid)
+                cur.execute("COMMIT")
+                return rowids
+            except:
+                cur.execute("ROLLBACK")
+                raise
+            finally:
+                cur.close()
+
+    #read methods
+    def load(self):
+        """ Return whole database as dict of mortals, discords and tiers """
+        with self._lock:
+            mortals = [row[0] for row in self._conn.execute("SELECT login FROM mortals")]
+            discords = dict(self._conn.execute("SELECT discord_id, login FROM discords"))
+            tiers = dict(self._conn.execute("SELECT login, tier FROM tiers"))
+        return {"discords": discords, "mortals": mortals, "tiers": tiers}
+
+    def journal_load(self):
+        """ Return list of (id, op, args) of unfinished operations """
+        with self._lock:
+            rows = list(self._conn.execute("SELECT id, op, args FROM journal ORDER BY id"))
+        return [(id, op, json.loads(args)) for id, op, args in rows]
+
+    #mutation methods
+    def add_mortal(self, login):
+        self._transaction(("INSERT OR IGNORE INTO mortals (login) VALUES (?)", (login,)))
+
+    def remove_mortal(self, login):
+        """ Remove account, its link to discord user and quota tier """
+        self._transaction(
+            ("DELETE FROM discords WHERE login = ?", (login,)),
+            ("DELETE FROM tiers WHERE login = ?", (login,)),
+            ("DELETE FROM mortals WHERE login = ?", (login,)),
+        )
+
+    def link(self, discord_id, login):
+        self._transaction(("INSERT OR REPLACE INTO discords (discord_id, login) VALUES (?, ?)", (str(discord_id), login)))
+
+    def set_tiers(self, logins, tier):
+        self._transaction(*[("INSERT OR REPLACE INTO tiers (login, tier) VALUES (?, ?)", (login, tier)) for login in logins])
+
+    def journal_add(self, op, args_list):
+        now = time.time()
+        return self._transaction(*[
+            ("INSERT INTO journal (op, args, created) VALUES (?, ?, ?)", (op, json.dumps(args), now))
+            for args in args_list
+        ])
+
+    def journal_update(self, id, args):
+        self._transaction(("UPDATE journal SET args = ? WHERE id = ?", (json.dumps(args), id)))
+
+    def journal_remove(self, ids):
+        self._transaction(*[("DELETE FROM journal WHERE id = ?", (id,)) for id in ids])
+
+    #migration methods
+    def import_json(self, path="db.json"):
+        """ One-time import of the legacy db.json file """
+        if not os.path.isfile(path):
+            return False
+
+        with open(path, "r") as f:
+            old = json.loads(f.read())
+
+        statements = [("INSERT OR IGNORE INTO mortals (login) VALUES (?)", (login,)) for login in old.get("mortals", [])]
+        statements += [
+            ("INSERT OR REPLACE INTO discords (discord_id, login) VALUES (?, ?)", (str(discord_id), login))
+            for discord_id, login in old.get("discords", {}).items()
+        ]
+        self._transaction(*statements)
+
+        os.rename(path, path + ".migrated")
+        logging.info("Imported %d accounts from %s", len(statements), path)
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,32 +1,164 @@
+import time
 import asyncio
+import itertools
 import logging
+import contextvars
+
+from metrics import REGISTRY
+
+queue_depth = REGISTRY.gauge("adminbot_queue_depth", "Jobs waiting in queue", ("queue",))
+job_wait = REGISTRY.histogram("adminbot_job_wait_seconds", "Time between adding job and its start", ("queue", "job"))
+job_run = REGISTRY.histogram("adminbot_job_run_seconds", "Job execution time", ("queue", "job"))
+job_errors = REGISTRY.counter("adminbot_job_errors_total", "Jobs that raised an exception", ("queue", "job"))
+job_rejected = REGISTRY.counter("adminbot_job_rejected_total", "Jobs rejected because queue was full", ("queue", "job"))
+job_merged = REGISTRY.counter("adminbot_job_merged_total", "Jobs merged into identical earlier job", ("queue", "job"))
+
+# Priority classes, lower runs first
+INTERACTIVE = 0     # users' own requests ($password, $whoami)
+READ = 1            # admins' lookups
+BULK = 2            # admins' changes, possibly of many accounts
+
+# id of the job being executed, copied into tasks and threads started by it
+current_job = contextvars.ContextVar("current_job", default=None)
+
+class JobFilter(logging.Filter):
+    """ Adds job_id of the job being executed to log records """
+    def filter(self, record):
+        if getattr(record, "job_id", None) is None:
+            record.job_id = current_job.get()
+        return True
+
+class QueueFullError(Exception):
+    pass
 
 class Tasker:
-    def __init__(self):
-        self.running = False    
+    def __init__(self, workers=1, name="tasker", maxsize=0):
+        self.running = False
+        self.workers = workers
+        self.name = name
+        self.maxsize = maxsize
+        self._tails = {}    # key -> completion future of the last job holding it
+        self._pending = {}  # dedup key -> completion future of job which didn't start yet
+        self._inflight = {} # dedup key -> completion future of running shared job
+        self._waiting = 0   # jobs which didn't start yet, queued or waiting for earlier jobs
+        self._waiters = {}  # completion future -> callbacks queuing jobs waiting for it
+        self._counter = itertools.count()
+        self.profile = None # profiler.Profile timing jobs started while profiling
+
+    async def addJob(self, coro, keys=(), priority=BULK, dedup=None, shared=False):
+        """ Add new coroutine to task queue
+
+        Jobs with lower priority value are started first, jobs of the same
+        priority in the order they were added. Jobs sharing any of the keys
+        are executed in the order they were added: a job waiting for
+        earlier jobs isn't queued (and doesn't hold a worker) until the
+        last of them is done, then it keeps its own priority. Jobs with
+        disjoint keys may run concurrently on other workers, so a long job
+        delays only jobs of its own keys.
 
-    async def addJob(self, coro):
-        """ Add new coroutine to task queue """
+        A job with dedup key equal to one of a job which didn't start yet
+        is merged into it: its coroutine is closed and False is returned.
+        Shared (read-only) jobs are merged also into running ones, so all
+        duplicates are served by one execution.
+
+        Raises QueueFullError (and closes the coroutine) when maxsize jobs
+        are already waiting.
+        """
         if not asyncio.iscoroutine(coro):
             raise ValueError("a coroutine was expected, got {!r}".format(coro))
-        
-        await self._queue.put(coro)
-        logging.info(f"Added new coroutine {coro}")
-    
-    async def _loop(self):
-        self._queue = asyncio.Queue()
+
+        if dedup is not None:
+            if dedup in self._pending or (shared and dedup in self._inflight):
+                job_merged.inc(queue=self.name, job=coro.__qualname__)
+                coro.close()
+                logging.info("Merged %s into identical job %s", coro.__qualname__, dedup)
+                return False
+
+        if self.maxsize and self._waiting >= self.maxsize:
+            job_rejected.inc(queue=self.name, job=coro.__qualname__)
+            coro.close()
+            raise QueueFullError(self.name)
+
+        keys = set(keys)
+        done = asyncio.get_running_loop().create_future()
+        after = {self._tails[key] for key in keys if key in self._tails}
+        for key in keys:
+            self._tails[key] = done
+
+        if dedup is not None:
+            self._pending[dedup] = done
+
+        job = (priority, next(self._counter), coro, keys, done, time.monotonic(), dedup, shared)
+        self._waiting += 1
+        queue_depth.set(self._waiting, queue=self.name)
+        if after:
+            self._park(job, after)
+        else:
+            self._queue.put_nowait(job)
+        return True
+
+    def _park(self, job, after):
+        # queue the job once all earlier jobs touching its keys are done,
+        # waiting inside a worker would block it for jobs of other keys
+        remaining = set(after)
+        def release(future):
+            remaining.discard(future)
+            if not remaining:
+                self._queue.put_nowait(job)
+        for future in after:
+            self._waiters.setdefault(future, []).append(release)
+
+    async def _worker(self):
         while 1:
-            coro = await self._queue.get()
-            logging.info(f"Executing coroutine: {coro}")
+            _, number, coro, keys, done, added, dedup, shared = await self._queue.get()
+            self._waiting -= 1
+            queue_depth.set(self._waiting, queue=self.name)
+            job = coro.__qualname__
+            job_id = "%s-%d" % (self.name, number)
+            token = current_job.set(job_id)
+            duration = None
             try:
-                await coro
+                if dedup is not None:
+                    # from now on duplicates have to run again, unless they can share the result
+                    del self._pending[dedup]
+                    if shared:
+                        self._inflight[dedup] = done
+                started = time.monotonic()
+                job_wait.observe(started - added, queue=self.name, job=job)
+                try:
+                    if self.profile is not None:
+                        await self.profile.timed(coro, job)
+                    else:
+                        await coro
+                finally:
+                    duration = time.monotonic() - started
+                    job_run.observe(duration, queue=self.name, job=job)
+                logging.info("Job %s done in %.3fs after waiting %.3fs", job, duration, started - added, extra={"duration": duration})
             except Exception as e:
-                logging.exception(f"{self} Error: {e}")
+                job_errors.inc(queue=self.name, job=job)
+                logging.exception("Job %s failed: %s", job, e, extra={"duration": duration})
+            finally:
+                current_job.reset(token)
+                done.set_result(None)
+                # queue jobs released by this one before the worker takes the next job
+                for release in self._waiters.pop(done, ()):
+                    release(done)
+                for key in keys:
+                    if self._tails.get(key) is done:
+                        del self._tails[key]
+                for jobs in (self._pending, self._inflight):
+                    if dedup is not None and jobs.get(dedup) is done:
+                        del jobs[dedup]
+
+    async def _loop(self):
+        # maxsize is checked by addJob, parked jobs have to fit in when released
+        self._queue = asyncio.PriorityQueue()
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
 
     async def start(self):
         """ Return infinite task to run with other tasks in program """
         if self.running:
             return None # TODO: Add already running exception
-        
+
         self.running = True
-        return asyncio.create_task(self._loop())
\ No newline at end of file
+        return asyncio.create_task(self._loop())
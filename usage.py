@@ -0,0 +1,106 @@
+import os
+import csv
+import math
+import time
+import asyncio
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def dir_size(path):
+    """ Return disk usage of directory tree in bytes """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+                except OSError:
+                    pass
+    return total
+
+class UsageCache:
+    """ Cached disk usage of all users.
+
+    Usage is read for everyone with one repquota pass. If quotas are not
+    available, home directories are walked in parallel instead: the first
+    refresh measures all of them, later ones only rescan entries older
+    than ttl, at least batch of them and enough to get through all homes
+    within ttl, so the cache is updated incrementally. The command only
+    reads the cache, the refresh runs in the background.
+    """
+    def __init__(self, base_dir, quota_fs=None, ttl=600, workers=4, batch=50):
+        self.base_dir = base_dir
+        self.quota_fs = quota_fs
+        self.ttl = ttl
+        self.batch = batch
+        self.interval = 60  # seconds between refreshes, set by start()
+        self.use_repquota = True
+        self.usage = {}     # name -> (bytes, measured at)
+        self.updated = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="usage")
+
+    def repquota(self):
+        command = ['repquota', '-u', '-O', 'csv']
+        command += [self.quota_fs] if self.quota_fs else ['-a']
+        out = subprocess.run(command, capture_output=True, check=True).stdout.decode()
+
+        usage = {}
+        for row in csv.DictReader(out.splitlines()):
+            # blocks are reported in KiB, summed over all filesystems
+            usage[row["User"]] = usage.get(row["User"], 0) + int(row["BlockUsed"]) * 1024
+        return usage
+
+    def scan(self):
+        now = time.monotonic()
+        homes = [e.name for e in os.scandir(self.base_dir) if e.is_dir(follow_symlinks=False) and not e.name.startswith('.')]
+        stale = sorted((n for n in homes if n not in self.usage or now - self.usage[n][1] > self.ttl), key=lambda n: self.usage.get(n, (0, 0))[1])
+        if self.updated is not None:
+            stale = stale[:max(self.batch, math.ceil(len(homes) * self.interval / self.ttl))]
+
+        sizes = self._executor.map(dir_size, [os.path.join(self.base_dir, n) for n in stale])
+        usage = {name: entry for name, entry in self.usage.items() if name in homes}
+        for name, size in zip(stale, sizes):
+            usage[name] = (size, now)
+        return usage
+
+    def refresh(self):
+        if self.use_repquota:
+            try:
+                now = time.monotonic()
+                self.usage = {name: (size, now) for name, size in self.repquota().items()}
+                self.updated = time.time()
+                return
+            except (OSError, subprocess.CalledProcessError, KeyError, ValueError) as e:
+                logging.warning("repquota not available, walking home directories: %s", e)
+                self.use_repquota = False
+
+        self.usage = self.scan()
+        self.updated = time.time()
+
+    def top(self, count=10, names=None):
+        """ Return list of (name, bytes) of the biggest consumers """
+        usage = [(name, entry[0]) for name, entry in self.usage.items() if names is None or name in names]
+        usage.sort(key=lambda x: x[1], reverse=True)
+        return usage[:count]
+
+    async def _loop(self, interval):
+        loop = asyncio.get_running_loop()
+        while 1:
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                logging.exception("Usage refresh error: %s", e)
+            await asyncio.sleep(interval)
+
+    async def start(self, interval=60):
+        """ Return infinite task refreshing the cache """
+        self.interval = interval
+        return asyncio.create_task(self._loop(interval))
@@ -0,0 +1,66 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+class UserCache:
+    """ Resolves discord users by id.
+
+    Looks into the gateway cache first, then into own LRU cache with TTL,
+    only then asks the REST API. Concurrent REST fetches are limited by
+    a semaphore (discord.py handles 429 responses of every request itself)
+    and simultaneous requests for the same id share one fetch.
+    """
+    def __init__(self, bot, ttl=600, maxsize=2048, concurrency=8):
+        self.bot = bot
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self._cache = OrderedDict()  # id -> (expires, user)
+        self._pending = {}           # id -> fetching task
+        self._semaphore = None
+
+    async def get(self, user_id):
+        user_id = int(user_id)
+
+        user = self.bot.get_user(user_id)
+        if user:
+            return user
+
+        entry = self._cache.get(user_id)
+        if entry:
+            if entry[0] > time.monotonic():
+                self._cache.move_to_end(user_id)
+                return entry[1]
+            del self._cache[user_id]
+
+        task = self._pending.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(user_id))
+            self._pending[user_id] = task
+            task.add_done_callback(lambda _: self._pending.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def get_many(self, user_ids):
+        """ Resolve many users concurrently, None for users that can't be fetched """
+        results = await asyncio.gather(*(self.get(i) for i in user_ids), return_exceptions=True)
+        users = []
+        for user_id, user in zip(user_ids, results):
+            if isinstance(user, Exception):
+                logging.warning("Can't fetch discord user %s: %s", user_id, user, extra={"discord_id": user_id})
+                user = None
+            users.append(user)
+        return users
+
+    async def _fetch(self, user_id):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            user = await self.bot.fetch_user(user_id)
+
+        self._cache[user_id] = (time.monotonic() + self.ttl, user)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return user